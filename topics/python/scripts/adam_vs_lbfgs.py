@@ -1,7 +1,6 @@
+import time
 import torch
-from jutility import plotting, util
-
-torch.manual_seed(2)
+from jutility import plotting, util, cli
 
 def get_random_orthogonal(d: int) -> torch.Tensor:
     A = torch.normal(0, 1, [d, d])
@@ -13,12 +12,87 @@ def random_uniform(d: int, lo: float, hi: float) -> torch.Tensor:
     return lo + (hi - lo) * torch.rand(d)
 
 class Loss:
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        raise NotImplementedError()
+
+class DenseLoss(Loss):
     def __init__(self, A: torch.Tensor):
         self._A = A
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         return x.mT @ self._A @ x
 
+class HouseholderLoss(Loss):
+    def __init__(self, Y: torch.Tensor, eig_vals: torch.Tensor):
+        """
+        Represents `A = Q.mT @ diag(eig_vals) @ Q` without storing `A` or `Q`,
+        where `Q = H_1 @ ... @ H_k`, `H_j = I - 2 * y_j @ y_j.mT`, and `y_j`
+        is column `j` of `Y` (shape `[d, k]`) after normalisation. `Q` is
+        stored in compact WY form `Q = I - Y @ T @ Y.mT`, with `T` upper
+        triangular (shape `[k, k]`), so `forward` (and its gradient) costs
+        `O(d * k)` time and memory instead of `O(d^2)`.
+
+        `Q` is the identity on the `d - k` dimensional complement of the span
+        of `Y`, so for `k << d` most eigenvectors of `A` stay close to the
+        coordinate axes. This favours diagonal preconditioners such as Adam,
+        so results are only comparable to a uniformly random rotation when `k`
+        is close to `d`.
+        """
+        super().__init__()
+        d, k = Y.shape
+        Y = Y / Y.norm(dim=-2, keepdim=True)
+        T = torch.zeros([k, k])
+        for j in range(k):
+            T[:j, j] = -2 * (T[:j, :j] @ (Y[:, :j].mT @ Y[:, j]))
+            T[j, j] = 2
+
+        self._Y = Y
+        self._T = T
+        self._sqrt_eig = eig_vals.sqrt().reshape(d, 1)
+
+    def rotate(self, x: torch.Tensor) -> torch.Tensor:
+        return x - self._Y @ (self._T @ (self._Y.mT @ x))
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        z = self._sqrt_eig * self.rotate(x)
+        return z.mT @ z
+
+    def to_dense(self) -> Loss:
+        d = self._sqrt_eig.shape[0]
+        Q = self.rotate(torch.eye(d))
+        return DenseLoss(Q.mT @ (self._sqrt_eig.square() * Q))
+
+def get_loss(
+    d:              int,
+    n_small:        int,
+    log_eig_lo:     float,
+    log_eig_hi:     float,
+    num_reflectors: int=0,
+) -> Loss:
+    """
+    If `num_reflectors` is 0, return a `DenseLoss` with a uniformly random
+    orthogonal basis, otherwise return a `HouseholderLoss` whose basis is a
+    product of `num_reflectors` random Householder reflections, which is only
+    close to uniformly random if `num_reflectors` is close to `d` (see
+    `HouseholderLoss`).
+    """
+    if num_reflectors > 0:
+        Q = None
+        Y = torch.normal(0, 1, [d, num_reflectors])
+    else:
+        Q = get_random_orthogonal(d)
+
+    eig_vals = torch.ones(d)
+    log_eig_small = random_uniform(n_small, log_eig_lo, log_eig_hi)
+    eig_vals[:n_small] = 10.0 ** log_eig_small
+
+    if Q is None:
+        return HouseholderLoss(Y, eig_vals)
+
+    A = Q.mT @ (eig_vals.reshape(d, 1) * Q)
+
+    return DenseLoss(A)
+
 class Learner:
     def __init__(
         self,
@@ -30,57 +104,297 @@ class Learner:
         self._x = torch.ones([d, 1], requires_grad=True)
         self._opt = opt_type([self._x])
         self._loss = loss
-        self._args = []
+        self._use_closure = use_closure
+        self.num_evals = 0
 
-        if use_closure:
-            self._args.append(lambda: loss.forward(self._x))
-
-    def step(self) -> float:
-        loss = self._loss.forward(self._x)
+    def closure(self) -> torch.Tensor:
         self._opt.zero_grad()
+        loss = self._loss.forward(self._x)
         loss.backward()
-        self._opt.step(*self._args)
-        return loss.item()
+        self.num_evals += 1
+        return loss
+
+    def step(self) -> torch.Tensor:
+        """
+        Return the loss before the step, without synchronising with `.item()`.
+        `self.num_evals` counts evaluations of the loss and its gradient, of
+        which `torch.optim.LBFGS` makes several per step.
+        """
+        if self._use_closure:
+            loss = self._opt.step(self.closure)
+        else:
+            loss = self.closure()
+            self._opt.step()
 
-d = 20
-d = 10
-n_small = 5
-T = 10000
+        return loss.detach().squeeze()
 
-Q = get_random_orthogonal(d)
+def train(
+    learner:        Learner,
+    T:              int,
+    log_interval:   int,
+) -> dict[str, torch.Tensor]:
+    """
+    Run `T` steps of `learner`, and every `log_interval` steps record the
+    loss into a preallocated buffer, along with the cumulative number of loss
+    and gradient evaluations and wall-clock time spent reaching that loss.
+    `log["total_time"]` is the wall-clock time spent in all `T` steps.
+    """
+    n_log = (T + log_interval - 1) // log_interval
+    log = {
+        "step":     torch.empty([n_log], dtype=torch.int64),
+        "loss":     torch.empty([n_log]),
+        "evals":    torch.empty([n_log], dtype=torch.int64),
+        "time":     torch.empty([n_log], dtype=torch.float64),
+    }
+    t_total = 0
+    for t in range(T):
+        num_evals = learner.num_evals
+        t_start = t_total
+        t0 = time.perf_counter()
+        loss = learner.step()
+        t_total += time.perf_counter() - t0
 
-assert isinstance(Q, torch.Tensor)
+        if t % log_interval == 0:
+            i = t // log_interval
+            log["step"][i] = t
+            log["loss"][i] = loss
+            log["evals"][i] = num_evals + 1
+            log["time"][i] = t_start
 
-eig_vals = torch.ones(d)
-eig_vals[:n_small] = 10.0 ** random_uniform(n_small, -5, -3)
+    log["total_time"] = torch.tensor(t_total, dtype=torch.float64)
+    return log
 
-A = Q.mT @ (eig_vals.reshape(d, 1) * Q)
+def main(
+    d:              int,
+    n_small:        int,
+    T:              int,
+    seed:           int,
+    num_reflectors: int,
+):
+    torch.manual_seed(seed)
 
-loss = Loss(A)
+    loss = get_loss(d, n_small, -5, -3, num_reflectors)
 
-adam = Learner(d, torch.optim.Adam,  loss)
-bfgs = Learner(d, torch.optim.LBFGS, loss, use_closure=True)
+    adam = Learner(d, torch.optim.Adam,  loss)
+    bfgs = Learner(d, torch.optim.LBFGS, loss, use_closure=True)
 
-table = util.Table(
-    util.TimeColumn(),
-    util.CountColumn(),
-    util.Column("adam", ".5f"),
-    util.Column("bfgs", ".5f"),
-    print_interval=util.TimeInterval(1),
-)
+    adam_log = train(adam, T, 1)
+    bfgs_log = train(bfgs, T, 1)
+
+    plotting.plot(
+        plotting.Line(adam_log["loss"], c="b", label="Adam"),
+        plotting.Line(bfgs_log["loss"], c="r", label="L-BFGS"),
+        plotting.Legend(),
+        log_y=True,
+        xlabel="t",
+        ylabel="$y_t$",
+        plot_name="adam_vs_lbfgs",
+    )
+
+def benchmark(
+    d_list:         list[int],
+    log_eig_list:   list[float],
+    n_small:        int,
+    T:              int,
+    log_interval:   int,
+    tol:            float,
+    seed:           int,
+    num_reflectors: int,
+):
+    """
+    For each dimension `d` and each `log_eig` in `log_eig_list`, use `n_small`
+    eigenvalues sampled log-uniformly from `[10^log_eig, 10^(log_eig + 2)]`
+    (the rest being 1). Compare Adam and L-BFGS by the number of steps, loss
+    and gradient evaluations, and seconds taken to reduce the loss by a factor
+    of `tol`, measured at the resolution of `log_interval`. If
+    `0 < num_reflectors < d`, the loss is only partially rotated (see
+    `HouseholderLoss`), which favours Adam, and a note is printed.
+    """
+    table = util.Table(
+        util.Column("d",            "i", width=6),
+        util.Column("log_eig",      ".1f"),
+        util.Column("opt",          width=-6),
+        util.Column("final_loss",   ".3e", width=10),
+        util.Column("steps_to_tol", width=12),
+        util.Column("evals_to_tol", width=12),
+        util.Column("time_to_tol",  width=11),
+        util.Column("evals_per_step",   ".2f", width=14),
+        util.Column("time_per_step",    ".3e", width=13),
+    )
+    subplots = []
+    for d in d_list:
+        if 0 < num_reflectors < d:
+            print_partial_rotation_note(d, num_reflectors)
+
+        for log_eig in log_eig_list:
+            torch.manual_seed(seed)
+            loss = get_loss(d, n_small, log_eig, log_eig + 2, num_reflectors)
+            learner_dict = {
+                "Adam":     Learner(d, torch.optim.Adam, loss),
+                "L-BFGS":   Learner(d, torch.optim.LBFGS, loss, True),
+            }
+            lines = []
+            for (name, learner), c in zip(learner_dict.items(), "br"):
+                log = train(learner, T, log_interval)
+                reached = (log["loss"] <= tol * log["loss"][0]).nonzero()
+                to_tol = ["-", "-", "-"]
+                if reached.numel() > 0:
+                    i = reached[0].item()
+                    to_tol = [
+                        "%i" % log["step"][i],
+                        "%i" % log["evals"][i],
+                        "%.3fs" % log["time"][i],
+                    ]
+
+                table.update(
+                    d=d,
+                    log_eig=log_eig,
+                    opt=name,
+                    final_loss=log["loss"][-1].item(),
+                    steps_to_tol=to_tol[0],
+                    evals_to_tol=to_tol[1],
+                    time_to_tol=to_tol[2],
+                    evals_per_step=(learner.num_evals / T),
+                    time_per_step=(log["total_time"].item() / T),
+                )
+                lines.append(plotting.Line(log["time"], log["loss"], c=c))
+
+            subplots.append(
+                plotting.Subplot(
+                    *lines,
+                    log_y=True,
+                    xlabel="Time (s)",
+                    ylabel="$y_t$",
+                    title="$d = %i, \\lambda_{min} \\geq 10^{%s}$"
+                    % (d, log_eig),
+                )
+            )
+
+    mp = plotting.MultiPlot(
+        *subplots,
+        legend=plotting.FigureLegend(
+            plotting.Line(c="b", label="Adam"),
+            plotting.Line(c="r", label="L-BFGS"),
+            loc="outside lower center",
+        ),
+    )
+    mp.save("adam_vs_lbfgs_benchmark")
+
+def benchmark_scaling(
+    d_list:         list[int],
+    num_reflectors: int,
+    max_dense_d:    int,
+    n_small:        int,
+    n_repeats:      int,
+    seed:           int,
+):
+    """
+    Time one evaluation of the loss and its gradient for `HouseholderLoss` and
+    its dense equivalent (for `d <= max_dense_d`), and report the relative
+    difference between their values. With the default `num_reflectors` much
+    smaller than `d`, these losses are only partially rotated (see
+    `HouseholderLoss`), which doesn't affect the timings but does affect
+    optimisation, so they shouldn't be reused to compare optimisers.
+    """
+    table = util.Table(
+        util.Column("d",            "i", width=6),
+        util.Column("loss_type",    width=-11),
+        util.Column("time",         ".3e"),
+        util.Column("rel_err",      ".3e"),
+    )
+    for d in d_list:
+        if num_reflectors < d:
+            print_partial_rotation_note(d, num_reflectors)
+
+        torch.manual_seed(seed)
+        loss = get_loss(d, n_small, -5, -3, num_reflectors)
+        loss_dict = {"householder": loss}
+        if d <= max_dense_d:
+            loss_dict["dense"] = loss.to_dense()
+
+        x = torch.normal(0, 1, [d, 1], requires_grad=True)
+        y_ref = None
+        for loss_type, loss in loss_dict.items():
+            time_list = []
+            for _ in range(n_repeats):
+                x.grad = None
+                with util.Timer(verbose=False) as timer:
+                    y = loss.forward(x)
+                    y.backward()
+
+                time_list.append(timer.get_last())
+
+            if y_ref is None:
+                y_ref = y.item()
+
+            table.update(
+                d=d,
+                loss_type=loss_type,
+                time=sorted(time_list)[n_repeats // 2],
+                rel_err=abs(y.item() - y_ref) / abs(y_ref),
+            )
+
+def print_partial_rotation_note(d: int, num_reflectors: int):
+    print(
+        "Note: d = %i, num_reflectors = %i, so the rotation is the identity "
+        "on a %i-dimensional subspace, and the loss is nearly axis-aligned "
+        "(see `HouseholderLoss`)"
+        % (d, num_reflectors, d - num_reflectors)
+    )
 
-for _ in range(T):
-    table.update(
-        adam=adam.step(),
-        bfgs=bfgs.step(),
+if __name__ == "__main__":
+    parser = cli.Parser(
+        cli.Arg(
+            "benchmark",
+            type=str,
+            default=None,
+            choices=["optim", "scaling"],
+        ),
+        cli.Arg("d",            type=int,   default=10),
+        cli.Arg("n_small",      type=int,   default=5),
+        cli.Arg("T",            type=int,   default=10000),
+        cli.Arg("seed",         type=int,   default=2),
+        cli.Arg("d_list",       type=int,   nargs="+",
+                default=[10, 100, 1000]),
+        cli.Arg("log_eig_list", type=float, nargs="+",
+                default=[-1, -3, -5]),
+        cli.Arg("log_interval", type=int,   default=10),
+        cli.Arg("tol",          type=float, default=1e-6),
+        cli.Arg("num_reflectors",   type=int, default=0),
+        cli.Arg("scaling_d_list",   type=int, nargs="+",
+                default=[100, 1000, 10000, 100000]),
+        cli.Arg("scaling_num_reflectors",   type=int, default=16),
+        cli.Arg("max_dense_d",      type=int, default=10000),
+        cli.Arg("n_repeats",        type=int, default=5),
     )
+    args = parser.parse_args()
 
-plotting.plot(
-    plotting.Line(table.get_data("adam"), c="b", label="Adam"),
-    plotting.Line(table.get_data("bfgs"), c="r", label="L-BFGS"),
-    plotting.Legend(),
-    log_y=True,
-    xlabel="t",
-    ylabel="$y_t$",
-    plot_name="adam_vs_lbfgs",
-)
+    with util.Timer("main"):
+        if args.get_value("benchmark") == "optim":
+            benchmark(
+                d_list=args.get_value("d_list"),
+                log_eig_list=args.get_value("log_eig_list"),
+                n_small=args.get_value("n_small"),
+                T=args.get_value("T"),
+                log_interval=args.get_value("log_interval"),
+                tol=args.get_value("tol"),
+                seed=args.get_value("seed"),
+                num_reflectors=args.get_value("num_reflectors"),
+            )
+        elif args.get_value("benchmark") == "scaling":
+            benchmark_scaling(
+                d_list=args.get_value("scaling_d_list"),
+                num_reflectors=args.get_value("scaling_num_reflectors"),
+                max_dense_d=args.get_value("max_dense_d"),
+                n_small=args.get_value("n_small"),
+                n_repeats=args.get_value("n_repeats"),
+                seed=args.get_value("seed"),
+            )
+        else:
+            main(
+                d=args.get_value("d"),
+                n_small=args.get_value("n_small"),
+                T=args.get_value("T"),
+                seed=args.get_value("seed"),
+                num_reflectors=args.get_value("num_reflectors"),
+            )
@@ -1,25 +1,13 @@
 import numpy as np
 from jutility import plotting
-
-def count_consecutive_increases(y: np.ndarray) -> np.ndarray:
-    dy = np.diff(y, prepend=y[0])
-    mask = np.where(dy > 0, 1, 0)
-
-    naive_counts = np.cumsum(mask)
-    reset_inds = (mask == 0)
-    reset_vals = np.diff(naive_counts[reset_inds], prepend=0)
-
-    mask[reset_inds] = -reset_vals
-    counts = np.cumsum(mask)
-
-    return counts
+import run_length
 
 rng = np.random.default_rng(0)
 
 n = 50
 x = np.linspace(0, 5, n)
 y = np.exp(-x) + rng.normal(0, 0.05, n)
-c = count_consecutive_increases(y)
+c = run_length.count_increases(y)
 
 x = np.arange(y.size)
 
@@ -1,25 +1,13 @@
 import numpy as np
 from jutility import plotting
-
-def count_consecutive_no_min(y: np.ndarray) -> np.ndarray:
-    best = np.minimum.accumulate(y)
-    mask = np.where(y > best, 1, 0)
-
-    naive_counts = np.cumsum(mask)
-    reset_inds = (mask == 0)
-    reset_vals = np.diff(naive_counts[reset_inds], prepend=0)
-
-    mask[reset_inds] = -reset_vals
-    counts = np.cumsum(mask)
-
-    return counts
+import run_length
 
 rng = np.random.default_rng(0)
 
 n = 50
 x = np.linspace(0, 5, n)
 y = np.exp(-x) + rng.normal(0, 0.05, n)
-c = count_consecutive_no_min(y)
+c = run_length.count_no_min(y)
 
 mp = plotting.MultiPlot(
     plotting.Subplot(
@@ -1,15 +1,21 @@
 import torch
-from jutility import plotting, util
+from jutility import plotting, util, cli
+import sgd_noise_floor
+import sweep_executor
 
-def main():
-    lr = 0.01
-    d = 100
-    n_steps = 1000
-    n_repeats = 10
-    n_std = 10
+def main(
+    lr:         float,
+    d:          int,
+    n_steps:    int,
+    n_repeats:  int,
+    n_std:      int,
+    engine:     str,
+    num_workers: int,
+    seed:       int,
+):
     std_list = util.log_range(0.01, 1, n_std)
 
-    torch.manual_seed(0)
+    torch.manual_seed(seed)
 
     ncs = plotting.NoisyCurveSweep(log_y=True)
 
@@ -21,16 +27,34 @@ def main():
         util.Column("y_T",      ".5f"),
     )
 
-    for std in std_list:
-        for repeat in range(n_repeats):
-            y_list = run_trial(
-                lr=lr,
-                std=std,
-                d=d,
-                n_steps=n_steps,
-            )
-            table.update(std=std, repeat=repeat, y_T=y_list[-1])
-            ncs.update(std, y_list)
+    if engine == "executor":
+        y = sweep_executor.run_sweep(
+            run_trial,
+            "std",
+            std_list,
+            n_repeats,
+            num_workers,
+            seed,
+            lr=lr,
+            d=d,
+            n_steps=n_steps,
+        )
+        for std, y_std in zip(std_list, y):
+            for repeat, y_list in enumerate(y_std):
+                table.update(std=std, repeat=repeat, y_T=y_list[-1])
+                ncs.update(std, y_list)
+    else:
+        y = sgd_noise_floor.run_trials(
+            lr=torch.tensor([lr]),
+            std=torch.tensor(std_list),
+            n_repeats=n_repeats,
+            d=d,
+            n_steps=n_steps,
+        )
+        for i, std in enumerate(std_list):
+            for repeat in range(n_repeats):
+                table.update(std=std, repeat=repeat, y_T=y[-1, i, repeat])
+                ncs.update(std, y[:, i, repeat].tolist())
 
     lines = ncs.plot(
         list(range(n_steps + 1)),
@@ -65,13 +89,14 @@ def run_trial(
     std:        float,
     d:          int,
     n_steps:    int,
+    generator:  (torch.Generator | None)=None,
 ) -> list[float]:
     x = torch.ones([d])
     y = 0.5 * x.square().sum().item()
     y_list = [y]
 
     for _ in range(n_steps):
-        eps = torch.normal(0, std, [d])
+        eps = torch.normal(0, std, [d], generator=generator)
         g = x + eps
         x -= lr * g
         y = 0.5 * x.square().sum().item()
@@ -93,5 +118,22 @@ def get_theory_line(
     return plotting.Line(t, y, c="k", ls=":", z=50)
 
 if __name__ == "__main__":
+    parser = cli.Parser(
+        cli.Arg("lr",            type=float, default=0.01),
+        cli.Arg("d",             type=int,   default=100),
+        cli.Arg("n_steps",       type=int,   default=1000),
+        cli.Arg("n_repeats",     type=int,   default=10),
+        cli.Arg("n_std",         type=int,   default=10),
+        cli.Arg(
+            "engine",
+            type=str,
+            default="batched",
+            choices=["executor", "batched"],
+        ),
+        cli.Arg("num_workers",   type=int,   default=0),
+        cli.Arg("seed",          type=int,   default=0),
+    )
+    args = parser.parse_args()
+
     with util.Timer("main"):
-        main()
+        main(**args.get_kwargs())
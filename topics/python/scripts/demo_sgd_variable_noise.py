@@ -1,15 +1,21 @@
+import math
 import torch
-from jutility import plotting, util
-
-def main():
-    k = 0.1
-    d = 100
-    n_steps = 1000
-    n_repeats = 10
-    n_lr = 10
+from jutility import plotting, util, cli
+import sweep_executor
+
+def main(
+    k:          float,
+    d:          int,
+    n_steps:    int,
+    n_repeats:  int,
+    n_lr:       int,
+    engine:     str,
+    num_workers: int,
+    seed:       int,
+):
     lr_list = util.log_range(0.01, 0.2, n_lr)
 
-    torch.manual_seed(0)
+    torch.manual_seed(seed)
 
     ncs = plotting.NoisyCurveSweep()
     nd = plotting.NoisyData(log_y=True)
@@ -22,17 +28,41 @@ def main():
         util.Column("y_T",      ".5f"),
     )
 
-    for lr in lr_list:
-        for repeat in range(n_repeats):
-            y_list = run_trial(
-                lr=lr,
-                k=k,
-                d=d,
-                n_steps=n_steps,
-            )
-            table.update(k=k, repeat=repeat, y_T=y_list[-1])
-            ncs.update(lr, y_list)
-            nd.update(lr, y_list[-1])
+    if engine == "executor":
+        y = sweep_executor.run_sweep(
+            run_trial,
+            "lr",
+            lr_list,
+            n_repeats,
+            num_workers,
+            seed,
+            k=k,
+            d=d,
+            n_steps=n_steps,
+        )
+        for lr, y_lr in zip(lr_list, y):
+            for repeat, y_list in enumerate(y_lr):
+                table.update(k=k, repeat=repeat, y_T=y_list[-1])
+                ncs.update(lr, y_list)
+                nd.update(lr, y_list[-1])
+    else:
+        trials_func = {
+            "batched":      run_trials,
+            "sufficient":   run_trials_sufficient,
+        }[engine]
+        y = trials_func(
+            lr=torch.tensor(lr_list),
+            k=k,
+            n_repeats=n_repeats,
+            d=d,
+            n_steps=n_steps,
+        )
+        for i, lr in enumerate(lr_list):
+            for repeat in range(n_repeats):
+                y_list = y[:, i, repeat].tolist()
+                table.update(k=k, repeat=repeat, y_T=y_list[-1])
+                ncs.update(lr, y_list)
+                nd.update(lr, y_list[-1])
 
     lines = ncs.plot(
         list(range(n_steps + 1)),
@@ -108,6 +138,7 @@ def run_trial(
     k:          float,
     d:          int,
     n_steps:    int,
+    generator:  (torch.Generator | None)=None,
 ) -> list[float]:
     x = torch.ones([d])
     y = 0.5 * x.square().sum().item()
@@ -115,7 +146,7 @@ def run_trial(
 
     for _ in range(n_steps):
         std = torch.sqrt(k * x.square().sum())
-        eps = torch.normal(0, std, [d])
+        eps = torch.normal(0, std, [d], generator=generator)
         g = x + eps
         x -= lr * g
         y = 0.5 * x.square().sum().item()
@@ -123,6 +154,64 @@ def run_trial(
 
     return y_list
 
+def run_trials(
+    lr:         torch.Tensor,
+    k:          float,
+    n_repeats:  int,
+    d:          int,
+    n_steps:    int,
+) -> torch.Tensor:
+    """
+    Batched version of `run_trial`, which simulates every value of `lr` and
+    every repeat at once. Returns a tensor with shape `[n_steps + 1, n_lr,
+    n_repeats]`.
+    """
+    lr = lr.reshape(-1, 1, 1)
+    n_lr = lr.shape[0]
+
+    x = torch.ones([n_lr, n_repeats, d])
+    eps = torch.empty([n_lr, n_repeats, d])
+    y = torch.empty([n_steps + 1, n_lr, n_repeats])
+    torch.sum(x.square(), dim=-1, out=y[0])
+
+    for t in range(n_steps):
+        std = torch.sqrt(k * y[t]).unsqueeze(-1)
+        eps.normal_().mul_(std).add_(x)
+        x.sub_(lr * eps)
+        torch.sum(x.square(), dim=-1, out=y[t + 1])
+
+    return y.mul_(0.5)
+
+def run_trials_sufficient(
+    lr:         torch.Tensor,
+    k:          float,
+    n_repeats:  int,
+    d:          int,
+    n_steps:    int,
+) -> torch.Tensor:
+    """
+    Equivalent in distribution to `run_trials`, but only simulates the
+    sufficient statistic `s = ||x||^2`, at a cost of `O(n_steps)` instead of
+    `O(n_steps * d)` per trial.
+
+    Splitting `eps ~ N(0, k * s * I)` into its components parallel and
+    orthogonal to `x` gives `s' = s * r`, where `r = ((1 - lr) - lr * sqrt(k)
+    * z)^2 + lr^2 * k * c`, `z ~ N(0, 1)` and `c ~ chi^2(d - 1)`. The factors
+    `r` are i.i.d. over time, so `log(s)` is a cumulative sum of `log(r)`.
+    """
+    lr = lr.reshape(1, -1, 1).double()
+    shape = [n_steps, lr.shape[1], n_repeats]
+
+    z = torch.randn(shape, dtype=torch.float64)
+    r = ((1 - lr) - lr * math.sqrt(k) * z).square()
+    if d > 1:
+        df = torch.tensor(d - 1, dtype=torch.float64)
+        r += lr.square() * k * torch.distributions.Chi2(df).sample(shape)
+
+    log_y = torch.zeros([n_steps + 1, *shape[1:]], dtype=torch.float64)
+    torch.cumsum(r.log(), dim=0, out=log_y[1:])
+    return log_y.exp().mul_(0.5 * d)
+
 def get_theory_line(
     lr:         float,
     k:          float,
@@ -137,5 +226,22 @@ def get_theory_line(
     return plotting.Line(t, y, c="k", ls=":", z=50)
 
 if __name__ == "__main__":
+    parser = cli.Parser(
+        cli.Arg("k",             type=float, default=0.1),
+        cli.Arg("d",             type=int,   default=100),
+        cli.Arg("n_steps",       type=int,   default=1000),
+        cli.Arg("n_repeats",     type=int,   default=10),
+        cli.Arg("n_lr",          type=int,   default=10),
+        cli.Arg(
+            "engine",
+            type=str,
+            default="batched",
+            choices=["executor", "batched", "sufficient"],
+        ),
+        cli.Arg("num_workers",   type=int,   default=0),
+        cli.Arg("seed",          type=int,   default=0),
+    )
+    args = parser.parse_args()
+
     with util.Timer("main"):
-        main()
+        main(**args.get_kwargs())
@@ -1,5 +1,7 @@
+from collections.abc import Iterable
 import torch
 import juml
+from jutility import util
 
 torch.manual_seed(0)
 juml.test_utils.torch_set_print_options()
@@ -11,42 +13,94 @@ class Quadratic:
         b: torch.Tensor,
         c: torch.Tensor,
     ):
+        """
+        Quadratics can be batched, in which case `a`, `b` and `c` have shapes
+        `[*B, m, m]`, `[*B, m]` and `[*B, 1]`, and every method operates on
+        all `B` quadratics at once.
+        """
         self.a = a
         self.b = b
         self.c = c
 
     @classmethod
-    def from_random(cls, m: int):
-        h = torch.normal(0, 1, [m, m])
+    def from_random(cls, m: int, batch_shape: tuple[int, ...]=()):
+        h = torch.normal(0, 1, [*batch_shape, m, m])
         a = h + h.mT
-        b = torch.normal(0, 1, [m])
-        c = torch.normal(0, 1, [1])
+        b = torch.normal(0, 1, [*batch_shape, m])
+        c = torch.normal(0, 1, [*batch_shape, 1])
         return cls(a, b, c)
 
     @classmethod
-    def from_data(cls, x: torch.Tensor, y: torch.Tensor):
-        n, m = x.shape
-        rc = [
-            [row, col]
-            for row in range(m)
-            for col in range(row, m)
-        ]
-        row, col = zip(*rc)
-        xx = x.unsqueeze(-1) * x.unsqueeze(-2)
-        xxut = xx[:, row, col]
-        d = torch.cat([xxut, x, torch.ones(n, 1)], dim=1)
-
-        s, _, _, _ = torch.linalg.lstsq(d, y)
-
-        hut, b, c = torch.split(s, [len(rc), m, 1])
-        h = torch.zeros([m, m])
-        h[row, col] = hut
+    def from_data(
+        cls,
+        x:          torch.Tensor,
+        y:          torch.Tensor,
+        chunk_size: (int | None)=None,
+    ):
+        """
+        Fit a quadratic to `x` (shape `[*B, n, m]`) and `y` (shape `[*B, n]`)
+        by least squares, with one batched `lstsq` for all `B` quadratics. If
+        `chunk_size` is given, use `from_chunks` to solve the normal
+        equations, accumulated over `chunk_size` rows at a time, so that the
+        design matrix is never materialised for all `n` rows.
+        """
+        if chunk_size is not None:
+            return cls.from_chunks(
+                (x[..., i:i+chunk_size, :], y[..., i:i+chunk_size])
+                for i in range(0, x.shape[-2], chunk_size)
+            )
+
+        d = get_features(x)
+        s, _, _, _ = torch.linalg.lstsq(d, y.unsqueeze(-1))
+        return cls.from_solution(s.squeeze(-1), x.shape[-1])
+
+    @classmethod
+    def from_chunks(
+        cls,
+        xy_chunks: Iterable[tuple[torch.Tensor, torch.Tensor]],
+    ):
+        """
+        Fit a quadratic by accumulating `D^T D` and `D^T y` in float64 over an
+        iterable of `(x, y)` chunks, where `D` is the design matrix returned by
+        `get_features`, and solving the normal equations. Memory is bounded by
+        the largest chunk and the `[p, p]` matrix `D^T D`, where `p = m * (m +
+        1) / 2 + m + 1`, independent of the total number of rows.
+        """
+        dtd = 0
+        dty = 0
+        x = None
+        for x, y in xy_chunks:
+            d = get_features(x).double()
+            dtd = dtd + d.mT @ d
+            dty = dty + d.mT @ y.double().unsqueeze(-1)
+
+        if x is None:
+            raise ValueError("from_chunks needs at least one chunk")
+
+        s = torch.linalg.solve(dtd, dty).squeeze(-1).to(y.dtype)
+        return cls.from_solution(s, x.shape[-1])
+
+    @classmethod
+    def from_solution(cls, s: torch.Tensor, m: int):
+        """
+        Unpack the least squares solution `s` for the features returned by
+        `get_features` into a quadratic.
+        """
+        row, col = torch.triu_indices(m, m)
+        hut, b, c = torch.split(s, [row.numel(), m, 1], dim=-1)
+        h = torch.zeros([*s.shape[:-1], m, m], dtype=s.dtype)
+        h[..., row, col] = hut
         a = 0.5 * (h + h.mT)
 
         return cls(a, b, c)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        return ((x @ self.a) * x).sum(dim=-1) + x @ self.b + self.c
+        """
+        `x` has shape `[*B, n, m]` (or `[n, m]` if not batched), and the output
+        has shape `[*B, n]`.
+        """
+        xb = (x * self.b.unsqueeze(-2)).sum(dim=-1)
+        return ((x @ self.a) * x).sum(dim=-1) + xb + self.c
 
     def get_turning_point(self) -> torch.Tensor:
         return torch.linalg.solve(self.a, -0.5*self.b)
@@ -57,6 +111,50 @@ class Quadratic:
             % (self.a, self.b, self.c)
         )
 
+def get_features(x: torch.Tensor) -> torch.Tensor:
+    """
+    Return the design matrix (shape `[*B, n, p]`) for fitting a quadratic to
+    `x` (shape `[*B, n, m]`), whose columns are the products `x_i * x_j` for
+    `i <= j` (in the order of `torch.triu_indices(m, m)`), then `x`, then
+    ones. Each row of the upper triangle is written directly into the design
+    matrix, without forming the `[*B, n, m, m]` outer products.
+    """
+    m = x.shape[-1]
+    num_ut = m * (m + 1) // 2
+    d = torch.empty([*x.shape[:-1], num_ut + m + 1], dtype=x.dtype)
+    j = 0
+    for i in range(m):
+        torch.mul(x[..., i:i+1], x[..., i:], out=d[..., j:j+m-i])
+        j += m - i
+
+    d[..., num_ut:num_ut+m] = x
+    d[..., -1] = 1
+    return d
+
+def benchmark_batched(batch_size: int, m: int, n: int):
+    """
+    Compare fitting `batch_size` quadratics (and finding their turning points)
+    with one batched call against a Python loop over the batch.
+    """
+    q = Quadratic.from_random(m, [batch_size])
+    x = torch.normal(0, 1, [batch_size, n, m])
+    y = q.forward(x)
+
+    with util.Timer("Python loop over %i quadratics" % batch_size):
+        x_opt_loop = torch.stack(
+            [
+                Quadratic.from_data(x[i], y[i]).get_turning_point()
+                for i in range(batch_size)
+            ]
+        )
+
+    with util.Timer("Batched fit of %i quadratics" % batch_size):
+        q_fit = Quadratic.from_data(x, y)
+        x_opt = q_fit.get_turning_point()
+
+    print("Max error in a:", (q_fit.a - q.a).abs().max())
+    print("Max difference to loop:", (x_opt - x_opt_loop).abs().max())
+
 m = 7
 m = 3
 n = m*(m+1)//2 + m + 1
@@ -78,3 +176,19 @@ print(q2)
 print("repr(Quadratic) matches:", repr(q) == repr(q2))
 print(x_opt)
 print(x_opt.grad)
+
+q3 = Quadratic.from_data(x, y, chunk_size=4)
+print("Chunked fit matches:", torch.allclose(q3.a, q2.a, atol=1e-4))
+
+m_large = 20
+n_large = 100000
+q_large = Quadratic.from_random(m_large)
+x_large = torch.normal(0, 1, [n_large, m_large])
+y_large = q_large.forward(x_large)
+q_large_fit = Quadratic.from_data(x_large, y_large, chunk_size=10000)
+print(
+    "Max error (m=%i, n=%i, chunked):" % (m_large, n_large),
+    (q_large_fit.a - q_large.a).abs().max(),
+)
+
+benchmark_batched(batch_size=10000, m=3, n=20)
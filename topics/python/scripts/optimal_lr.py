@@ -1,5 +1,5 @@
 import torch
-from jutility import plotting, util
+from jutility import plotting, util, cli
 
 class Objective:
     def forward(self, x: torch.Tensor) -> torch.Tensor:
@@ -8,47 +8,135 @@ class Objective:
     def grad(self, x: torch.Tensor) -> torch.Tensor:
         raise NotImplementedError
 
+    def value_and_grad(
+        self,
+        x: torch.Tensor,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        return self.forward(x), self.grad(x)
+
+    def get_optimal_lr(
+        self,
+        x:      torch.Tensor,
+        v:      torch.Tensor,
+        alpha:  float,
+        fx:     torch.Tensor,
+        g:      torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        Return the learning rate which minimises a quadratic fitted to `f(x -
+        alpha * v)`, `f(x)` and `f(x + alpha * v)`, given `fx = f(x)` and `g =
+        grad(x)`, which subclasses can use to avoid evaluating `f`. Where the
+        fitted curvature is not positive (EG once `x` reaches the minimum),
+        the learning rate is 0.
+        """
+        fxp = self.forward(x + alpha * v)
+        fxm = self.forward(x - alpha * v)
+        curvature = fxp + fxm - 2 * fx
+        lr = 0.5 * alpha * (fxp - fxm) / curvature
+        return torch.where(curvature > 0, lr, 0)
+
 class HyperEllipsoid(Objective):
     def __init__(
         self,
         d:              int,
-        condition_num:  float,
+        condition_num:  (float | torch.Tensor),
     ):
-        self.a = torch.linspace(1/condition_num, 1, d)
+        """
+        `condition_num` can be a tensor, EG with shape `[n, 1, 1]`, in which
+        case `self.a` has shape `[n, 1, d]`, and `forward` and `grad` evaluate
+        `n` objectives at once on inputs with shape `[n, batch, d]`.
+        """
+        a_min = 1 / torch.as_tensor(condition_num, dtype=torch.float32)
+        self.a = torch.lerp(a_min, torch.ones([]), torch.linspace(0, 1, d))
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        return 0.5 * (x.square() @ self.a)
+        return 0.5 * (x.square() * self.a).sum(dim=-1)
 
     def grad(self, x: torch.Tensor) -> torch.Tensor:
         return self.a * x
 
+    def value_and_grad(
+        self,
+        x: torch.Tensor,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        g = self.a * x
+        return 0.5 * (x * g).sum(dim=-1), g
+
+    def get_optimal_lr(
+        self,
+        x:      torch.Tensor,
+        v:      torch.Tensor,
+        alpha:  float,
+        fx:     torch.Tensor,
+        g:      torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        `f` is quadratic, so the fitted quadratic is exact, and its minimum is
+        at `(g . v) / (v^2 . a)` for any `alpha`, which only needs two
+        reductions instead of two full evaluations.
+        """
+        gv = (g * v).sum(dim=-1)
+        vav = (v.square() * self.a).sum(dim=-1)
+        return torch.where(vav > 0, gv / vav, 0)
+
 class Learner:
     x:      torch.Tensor
     kwargs: dict
+    fx:     (torch.Tensor | None) = None
+    g:      (torch.Tensor | None) = None
 
     def step(self, f: Objective):
         raise NotImplementedError
 
     def eval(self, f: Objective) -> torch.Tensor:
-        return f.forward(self.x)
+        """
+        Return `f(self.x)`, evaluating `f` and its gradient together at most
+        once between updates to `self.x`, so that `step` can reuse the value
+        and gradient computed by `train` at the end of the previous step.
+        """
+        if self.fx is None:
+            self.fx, self.g = f.value_and_grad(self.x)
+
+        return self.fx
+
+    def update(self, dx: torch.Tensor):
+        self.x -= dx
+        self.fx = None
+        self.g = None
 
     def train(
         self,
-        f:      Objective,
-        steps:  int,
-    ) -> tuple[torch.Tensor, list[float]]:
-        x_list = [self.x.tolist()]
-        f_list = [self.eval(f).item()]
-        for _ in range(steps):
+        f:          Objective,
+        steps:      int,
+        record_x:   bool=True,
+    ) -> tuple[(torch.Tensor | None), torch.Tensor]:
+        """
+        Returns the history of `x` with shape `[steps + 1, *x.shape]` (or
+        `None` if `record_x` is `False`), and the history of `f(x)` with shape
+        `[steps + 1, *x.shape[:-1]]`.
+        """
+        fx = self.eval(f)
+        f_hist = torch.empty([steps + 1, *fx.shape])
+        f_hist[0] = fx
+        x_hist = None
+        if record_x:
+            x_hist = torch.empty([steps + 1, *self.x.shape])
+            x_hist[0] = self.x
+
+        for t in range(steps):
             self.step(f)
-            x_list.append(self.x.tolist())
-            f_list.append(self.eval(f).item())
+            f_hist[t + 1] = self.eval(f)
+            if record_x:
+                x_hist[t + 1] = self.x
 
-        x = torch.tensor(x_list)
-        return x, f_list
+        return x_hist, f_hist
 
     def __repr__(self) -> str:
-        return util.format_type(type(self), **self.kwargs, item_fmt="%s=%s")
+        kwargs = {
+            k: ("%.2f" % v if isinstance(v, (int, float)) else v)
+            for k, v in self.kwargs.items()
+        }
+        return util.format_type(type(self), **kwargs, item_fmt="%s=%s")
 
 class OptimalLr(Learner):
     def __init__(
@@ -61,13 +149,11 @@ class OptimalLr(Learner):
         self.kwargs = {"$\\alpha$": alpha}
 
     def step(self, f: Objective):
-        g = f.grad(self.x)
-        fx = f.forward(self.x)
-        fxp = f.forward(self.x + self.alpha * g)
-        fxm = f.forward(self.x - self.alpha * g)
-        lr = 0.5 * self.alpha * (fxp - fxm) / (fxp + fxm - 2 * fx)
+        fx = self.eval(f)
+        g = self.g
+        lr = f.get_optimal_lr(self.x, g, self.alpha, fx, g)
 
-        self.x -= lr * g
+        self.update(lr.unsqueeze(-1) * g)
 
 class OptimalLrMomentum(Learner):
     def __init__(
@@ -80,19 +166,16 @@ class OptimalLrMomentum(Learner):
         self.alpha = alpha
         self.beta = beta
         self.m = torch.zeros_like(x0)
-        self.kwargs = {"$\\alpha$": "%.2f" % alpha, "$\\beta$": "%.2f" % beta}
+        self.kwargs = {"$\\alpha$": alpha, "$\\beta$": beta}
 
     def step(self, f: Objective):
-        g = f.grad(self.x)
+        fx = self.eval(f)
         self.m *= self.beta
-        self.m += g
+        self.m += self.g
 
-        fx = f.forward(self.x)
-        fxp = f.forward(self.x + self.alpha * self.m)
-        fxm = f.forward(self.x - self.alpha * self.m)
-        lr = 0.5 * self.alpha * (fxp - fxm) / (fxp + fxm - 2 * fx)
+        lr = f.get_optimal_lr(self.x, self.m, self.alpha, fx, self.g)
 
-        self.x -= lr * self.m
+        self.update(lr.unsqueeze(-1) * self.m)
 
 class Momentum(Learner):
     def __init__(
@@ -105,70 +188,173 @@ class Momentum(Learner):
         self.alpha = alpha
         self.beta = beta
         self.m = torch.zeros_like(x0)
-        self.kwargs = {"$\\alpha$": "%.2f" % alpha, "$\\beta$": "%.2f" % beta}
+        self.kwargs = {"$\\alpha$": alpha, "$\\beta$": beta}
 
     def step(self, f: Objective):
-        g = f.grad(self.x)
+        self.eval(f)
         self.m *= self.beta
-        self.m += g
-
-        self.x -= self.alpha * self.m
-
-condition_num = 3
-steps = 50
-
-f = HyperEllipsoid(2, condition_num)
-
-alpha_opt   = 2 / ((1 / condition_num) + 1)
-alpha_opt_m = (2 / ((1 / condition_num) ** 0.5 + 1)) ** 2
-beta_opt_m  = ((condition_num ** 0.5 - 1) / (condition_num ** 0.5 + 1)) ** 2
-
-learner_list = [
-    OptimalLr(torch.ones(2), 0.1),
-    OptimalLrMomentum(torch.ones(2), 0.1, beta_opt_m),
-    OptimalLrMomentum(torch.ones(2), 0.1, 0.01),
-    Momentum(torch.ones(2), alpha_opt, 0),
-    Momentum(torch.ones(2), alpha_opt_m, beta_opt_m),
-]
-
-x_lines = []
-f_lines = []
-legend_lines = []
-cp = plotting.ColourPicker(len(learner_list), cmap_name="gist_rainbow")
-
-for learner, c in zip(learner_list, cp):
-    assert isinstance(learner, Learner)
-    x, f_list = learner.train(f, steps)
-    x_lines.append(plotting.Line(x[:, 0], x[:, 1], c=c))
-    f_lines.append(plotting.Line(f_list, m="o", c=c))
-    legend_lines.append(plotting.Line(c=c, label=repr(learner)))
-
-w = 100
-h = 100
-x_1w    = torch.linspace(-1, 1, w).unsqueeze(-2)
-y_h1    = torch.linspace(-1, 1, h).unsqueeze(-1)
-x_hw    = torch.tile(x_1w, [h, 1])
-y_hw    = torch.tile(y_h1, [1, w])
-xy_hw2  = torch.stack([x_hw, y_hw], dim=-1)
-z = f.forward(xy_hw2)
-
-mp = plotting.MultiPlot(
-    plotting.Subplot(
-        plotting.Contour(x_1w.squeeze(), y_h1.squeeze(), torch.log(z), 20),
-        *x_lines,
-        axis_square=True,
-        grid=False,
-    ),
-    plotting.Subplot(
-        *f_lines,
-        log_y=True,
-    ),
-    figsize=[8, 5],
-    legend=plotting.FigureLegend(
-        *legend_lines,
-        num_rows=None,
-        loc="outside lower center",
-    ),
-    title="$\\kappa = %i$" % condition_num,
-)
-mp.save()
+        self.m += self.g
+
+        self.update(self.alpha * self.m)
+
+def main(
+    condition_num:  float,
+    steps:          int,
+):
+    f = HyperEllipsoid(2, condition_num)
+
+    alpha_opt   = 2 / ((1 / condition_num) + 1)
+    alpha_opt_m = (2 / ((1 / condition_num) ** 0.5 + 1)) ** 2
+    beta_opt_m  = ((condition_num ** 0.5 - 1) / (condition_num ** 0.5 + 1)) ** 2
+
+    learner_list = [
+        OptimalLr(torch.ones(2), 0.1),
+        OptimalLrMomentum(torch.ones(2), 0.1, beta_opt_m),
+        OptimalLrMomentum(torch.ones(2), 0.1, 0.01),
+        Momentum(torch.ones(2), alpha_opt, 0),
+        Momentum(torch.ones(2), alpha_opt_m, beta_opt_m),
+    ]
+
+    x_lines = []
+    f_lines = []
+    legend_lines = []
+    cp = plotting.ColourPicker(len(learner_list), cmap_name="gist_rainbow")
+
+    for learner, c in zip(learner_list, cp):
+        assert isinstance(learner, Learner)
+        x, f_hist = learner.train(f, steps)
+        x_lines.append(plotting.Line(x[:, 0], x[:, 1], c=c))
+        f_lines.append(plotting.Line(f_hist, m="o", c=c))
+        legend_lines.append(plotting.Line(c=c, label=repr(learner)))
+
+    w = 100
+    h = 100
+    x_1w    = torch.linspace(-1, 1, w).unsqueeze(-2)
+    y_h1    = torch.linspace(-1, 1, h).unsqueeze(-1)
+    x_hw    = torch.tile(x_1w, [h, 1])
+    y_hw    = torch.tile(y_h1, [1, w])
+    xy_hw2  = torch.stack([x_hw, y_hw], dim=-1)
+    z = f.forward(xy_hw2)
+
+    mp = plotting.MultiPlot(
+        plotting.Subplot(
+            plotting.Contour(x_1w.squeeze(), y_h1.squeeze(), torch.log(z), 20),
+            *x_lines,
+            axis_square=True,
+            grid=False,
+        ),
+        plotting.Subplot(
+            *f_lines,
+            log_y=True,
+        ),
+        figsize=[8, 5],
+        legend=plotting.FigureLegend(
+            *legend_lines,
+            num_rows=None,
+            loc="outside lower center",
+        ),
+        title="$\\kappa = %i$" % condition_num,
+    )
+    mp.save()
+
+def get_learners(
+    x0:             torch.Tensor,
+    condition_num:  torch.Tensor,
+) -> dict[str, Learner]:
+    alpha_opt   = 2 / ((1 / condition_num) + 1)
+    alpha_opt_m = (2 / ((1 / condition_num) ** 0.5 + 1)) ** 2
+    beta_opt_m  = ((condition_num ** 0.5 - 1) / (condition_num ** 0.5 + 1)) ** 2
+    return {
+        "OptimalLr":            OptimalLr(x0.clone(), 0.1),
+        "OptimalLrMomentum*":   OptimalLrMomentum(x0.clone(), 0.1, beta_opt_m),
+        "OptimalLrMomentum":    OptimalLrMomentum(x0.clone(), 0.1, 0.01),
+        "Momentum(beta=0)":     Momentum(x0.clone(), alpha_opt, 0),
+        "Momentum*":            Momentum(x0.clone(), alpha_opt_m, beta_opt_m),
+    }
+
+def benchmark(
+    d_list:             list[int],
+    condition_num_list: list[float],
+    n_starts:           int,
+    steps:              int,
+    tol:                float,
+    seed:               int,
+):
+    """
+    Train every learner on a batch of `n_starts` random start points for each
+    condition number at once (`x` has shape `[n_condition_num, n_starts,
+    d]`), and report the median number of steps needed to reduce `f` by a
+    factor of `tol`, the fraction of start points which reach `tol`, the
+    fraction of start points whose `f` stays finite for every step (start
+    points which produce NaN or inf are never counted as converged), and the
+    wall-clock time per step for the whole batch. Learners marked `*` use the
+    optimal hyperparameters for each condition number.
+    """
+    torch.manual_seed(seed)
+    condition_num = torch.tensor(condition_num_list).reshape(-1, 1, 1)
+    table = util.Table(
+        util.Column("learner",          width=-20),
+        util.Column("d",                "i", width=6),
+        util.Column("condition_num",    ".1f", width=13),
+        util.Column("steps_to_tol",     ".1f", width=12),
+        util.Column("converged",        ".2f"),
+        util.Column("finite",           ".2f"),
+        util.Column("time_per_step",    ".3e", width=13),
+    )
+    for d in d_list:
+        f = HyperEllipsoid(d, condition_num)
+        x0 = torch.randn([len(condition_num_list), n_starts, d])
+        for name, learner in get_learners(x0, condition_num).items():
+            with util.Timer(verbose=False) as timer:
+                _, f_hist = learner.train(f, steps, record_x=False)
+
+            below_tol = (f_hist <= tol * f_hist[0])
+            finite = f_hist.isfinite().all(dim=0)
+            converged = below_tol.any(dim=0) & finite
+            steps_to_tol = torch.where(
+                converged,
+                below_tol.int().argmax(dim=0).float(),
+                torch.nan,
+            )
+            for i, kappa in enumerate(condition_num_list):
+                table.update(
+                    learner=name,
+                    d=d,
+                    condition_num=kappa,
+                    steps_to_tol=steps_to_tol[i].nanmedian().item(),
+                    converged=converged[i].float().mean().item(),
+                    finite=finite[i].float().mean().item(),
+                    time_per_step=(timer.get_last() / steps),
+                )
+
+if __name__ == "__main__":
+    parser = cli.Parser(
+        cli.Arg("benchmark",            action="store_true"),
+        cli.Arg("condition_num",        type=float, default=3),
+        cli.Arg("steps",                type=int,   default=50),
+        cli.Arg("d_list",               type=int,   nargs="+",
+                default=[2, 100, 1000]),
+        cli.Arg("condition_num_list",   type=float, nargs="+",
+                default=[3, 30, 300]),
+        cli.Arg("n_starts",             type=int,   default=64),
+        cli.Arg("benchmark_steps",      type=int,   default=1000),
+        cli.Arg("tol",                  type=float, default=1e-6),
+        cli.Arg("seed",                 type=int,   default=0),
+    )
+    args = parser.parse_args()
+
+    with util.Timer("main"):
+        if args.get_value("benchmark"):
+            benchmark(
+                d_list=args.get_value("d_list"),
+                condition_num_list=args.get_value("condition_num_list"),
+                n_starts=args.get_value("n_starts"),
+                steps=args.get_value("benchmark_steps"),
+                tol=args.get_value("tol"),
+                seed=args.get_value("seed"),
+            )
+        else:
+            main(
+                condition_num=args.get_value("condition_num"),
+                steps=args.get_value("steps"),
+            )
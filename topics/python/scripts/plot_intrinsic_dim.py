@@ -1,7 +1,8 @@
+from concurrent.futures import ThreadPoolExecutor
 import torch
 from jutility import plotting, util, cli
 import juml
-
+import sweep_executor
 
 def main(
     args:   cli.ParsedArgs,
@@ -9,6 +10,8 @@ def main(
     N:      float,
     D:      int,
     D_int:  int,
+    chunk_size:     int,
+    num_workers:    int,
 ):
     torch.manual_seed(seed)
     juml.test_utils.torch_set_print_options(threshold=int(1e9))
@@ -18,14 +21,26 @@ def main(
     A[i[:D_int], i[:D_int]] = 1
     print(A)
 
-    eps = torch.normal(0, 1, [int(N), D, 1])
-    eAe = eps.mT @ A @ eps
-    eeAee = eps @ (eps.mT @ A @ eps) @ eps.mT
-    eeAee_mean = eeAee.mean(0)
-    print(eeAee_mean)
-
     eeAee_expected = torch.full([D], D_int, dtype=torch.float32)
     eeAee_expected[:D_int] += 2
+
+    if chunk_size > 0:
+        eeAee_mean = get_eeAee_mean_chunked(
+            seed=seed,
+            N=int(N),
+            D=D,
+            D_int=D_int,
+            chunk_size=chunk_size,
+            num_workers=num_workers,
+            eeAee_expected=eeAee_expected,
+        )
+    else:
+        eps = torch.normal(0, 1, [int(N), D, 1])
+        eAe = eps.mT @ A @ eps
+        eeAee = eps @ (eps.mT @ A @ eps) @ eps.mT
+        eeAee_mean = eeAee.mean(0)
+
+    print(eeAee_mean)
     print(torch.stack([eeAee_mean[i, i], eeAee_expected]))
 
     kw = {
@@ -42,12 +57,77 @@ def main(
     )
     mp.save()
 
+def get_eeAee_mean_chunked(
+    seed:           int,
+    N:              int,
+    D:              int,
+    D_int:          int,
+    chunk_size:     int,
+    num_workers:    int,
+    eeAee_expected: torch.Tensor,
+) -> torch.Tensor:
+    """
+    Estimate `E[eps @ (eps.mT @ A @ eps) @ eps.mT]` in chunks of `chunk_size`
+    samples, so memory is `O(chunk_size * D + D^2)` rather than `O(N * D^2)`.
+    Because `A` is the projection onto the first `D_int` coordinates, `eps.mT
+    @ A @ eps` is the squared norm of the first `D_int` entries of `eps`, so
+    each chunk reduces to one `[D, chunk_size] @ [chunk_size, D]` product.
+
+    Each chunk has its own generator (derived from `seed` and its index), and
+    chunk sums are accumulated in order, so results do not depend on
+    `num_workers` (the number of threads used to compute chunks). The error of
+    the running mean against `eeAee_expected` is printed as chunks accumulate.
+    """
+    table = util.Table(
+        util.CountColumn(),
+        util.TimeColumn(),
+        util.Column("n",            "i", width=10),
+        util.Column("diag_err",     ".5f"),
+        util.Column("off_diag_max", ".5f", width=12),
+        print_interval=util.TimeInterval(1),
+    )
+    eeAee_sum = torch.zeros([D, D], dtype=torch.float64)
+    off_diag = ~torch.eye(D, dtype=torch.bool)
+    chunk_list = [
+        (i, min(chunk_size, N - n))
+        for i, n in enumerate(range(0, N, chunk_size))
+    ]
+
+    def get_chunk_sum(chunk: tuple[int, int]) -> torch.Tensor:
+        i, n = chunk
+        g = sweep_executor.get_generator(seed, i)
+        eps = torch.normal(0, 1, [n, D], generator=g)
+        eAe = eps[:, :D_int].square().sum(dim=-1, keepdim=True)
+        return ((eAe * eps).mT @ eps).double()
+
+    with ThreadPoolExecutor(max(num_workers, 1)) as executor:
+        n = 0
+        for (_, n_b), chunk_sum in zip(
+            chunk_list,
+            executor.map(get_chunk_sum, chunk_list),
+        ):
+            eeAee_sum += chunk_sum
+            n += n_b
+            eeAee_mean = eeAee_sum / n
+            table.update(
+                n=n,
+                diag_err=(
+                    (eeAee_mean.diagonal() - eeAee_expected).abs().max().item()
+                ),
+                off_diag_max=eeAee_mean[off_diag].abs().max().item(),
+            )
+
+    table.print_last()
+    return eeAee_mean.float()
+
 if __name__ == "__main__":
     parser = cli.Parser(
         cli.Arg("seed",     type=int,   default=0),
         cli.Arg("N",        type=float, default=1e6),
         cli.Arg("D",        type=int,   default=10),
         cli.Arg("D_int",    type=int,   default=3),
+        cli.Arg("chunk_size",   type=int,   default=0),
+        cli.Arg("num_workers",  type=int,   default=0),
     )
     args = parser.parse_args()
 
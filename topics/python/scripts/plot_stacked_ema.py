@@ -1,46 +1,178 @@
 import numpy as np
-from jutility import plotting, util
+from jutility import plotting, util, cli
 
-t = 15000
-depth = 100
-alpha = 0.01
-threshold = 0.5
-threshold_str = "Threshold = %s" % threshold
+def main(
+    t:          int,
+    depth:      int,
+    alpha:      float,
+    threshold:  float,
+    method:     str,
+):
+    threshold_str = "Threshold = %s" % threshold
 
-x = np.zeros([depth, t])
-x[0] = 1
-x = x.tolist()
+    with util.Timer(method):
+        x = METHODS[method](t, depth, alpha)
+
+    a = get_threshold_times(x, threshold)
+
+    cp = plotting.ColourPicker(depth, False)
+
+    mp = plotting.MultiPlot(
+        plotting.Subplot(
+            *[
+                plotting.Line(x[di], c=c)
+                for di, c in enumerate(reversed(list(cp)))
+            ],
+            plotting.HLine(threshold, c="k", ls="--", label=threshold_str),
+            plotting.Legend(),
+            xlabel="Time",
+            ylabel="Filter output",
+        ),
+        plotting.Subplot(
+            plotting.Line(range(depth, 0, -1), a, c="k"),
+            xlabel="Layer",
+            ylabel="Time until threshold",
+        ),
+        cp.get_colourbar(horizontal=True, label="Layer"),
+        figsize=[10, 5],
+        hr=[1, 0.1],
+        title="Stacked EMAs ($\\alpha = %s$)" % alpha,
+    )
+    mp.save("plot_stacked_ema")
+
+def stacked_ema_loop(t: int, depth: int, alpha: float) -> np.ndarray:
+    x = np.zeros([depth, t])
+    x[0] = 1
+    x = x.tolist()
 
-with util.Timer():
     for ti in range(1, t):
         for di in range(1, depth):
             x[di][ti] = (1 - alpha) * x[di][ti-1] + alpha * x[di-1][ti-1]
 
-x = np.array(x)
-x_masked = np.where(x < threshold, x.max(), x)
-a = np.argmin(x_masked, 1)
-
-cp = plotting.ColourPicker(depth, False)
-
-mp = plotting.MultiPlot(
-    plotting.Subplot(
-        *[
-            plotting.Line(x[di], c=c)
-            for di, c in enumerate(reversed(list(cp)))
-        ],
-        plotting.HLine(threshold, c="k", ls="--", label=threshold_str),
-        plotting.Legend(),
-        xlabel="Time",
-        ylabel="Filter output",
-    ),
-    plotting.Subplot(
-        plotting.Line(range(depth, 0, -1), a, c="k"),
-        xlabel="Layer",
-        ylabel="Time until threshold",
-    ),
-    cp.get_colourbar(horizontal=True, label="Layer"),
-    figsize=[10, 5],
-    hr=[1, 0.1],
-    title="Stacked EMAs ($\\alpha = %s$)" % alpha,
-)
-mp.save("plot_stacked_ema")
+    return np.array(x)
+
+def stacked_ema_stack(t: int, depth: int, alpha: float) -> np.ndarray:
+    """
+    Advance every layer of the stack at once for each time step. The array is
+    stored time-major so that each step reads and writes contiguous memory.
+    """
+    x = np.zeros([t, depth])
+    x[:, 0] = 1
+
+    for ti in range(1, t):
+        np.multiply(1 - alpha, x[ti-1, 1:], out=x[ti, 1:])
+        x[ti, 1:] += alpha * x[ti-1, :-1]
+
+    return x.T
+
+def stacked_ema_closed_form(t: int, depth: int, alpha: float) -> np.ndarray:
+    """
+    Layer `d` at time `ti` satisfies the same recurrence and initial values as
+    `P(S >= d)` for `S ~ Binomial(ti, alpha)`, so each layer is a binomial
+    tail probability. The binomial PMF for each `d` is computed from the PMF
+    for `d - 1` in log space for every time step at once, and accumulated into
+    the log CDF with `np.logaddexp`, which avoids underflow for large `t`.
+    """
+    ti = np.arange(t)
+    x = np.empty([depth, t])
+    x[0] = 1
+
+    log_pmf = ti * np.log1p(-alpha)
+    log_cdf = log_pmf.copy()
+    log_odds = np.log(alpha) - np.log1p(-alpha)
+    with np.errstate(divide="ignore"):
+        for di in range(1, depth):
+            x[di] = -np.expm1(log_cdf)
+            log_pmf += np.log(np.maximum(ti - di + 1, 0) / di) + log_odds
+            np.logaddexp(log_cdf, log_pmf, out=log_cdf)
+
+    return x
+
+def get_threshold_times(x: np.ndarray, threshold: float) -> np.ndarray:
+    """
+    Return the first time at which each layer reaches `threshold` (or 0 if it
+    never does), which is where each layer's smallest value at or above
+    `threshold` occurs, because every layer is non-decreasing in time.
+    """
+    return np.argmax(x >= threshold, axis=1)
+
+METHODS = {
+    "loop":         stacked_ema_loop,
+    "stack":        stacked_ema_stack,
+    "closed_form":  stacked_ema_closed_form,
+}
+
+def benchmark(
+    t_list:     list[int],
+    depth_list: list[int],
+    alpha:      float,
+    threshold:  float,
+    max_loop_size: int,
+):
+    table = util.Table(
+        util.Column("t",            "i", width=8),
+        util.Column("depth",        "i", width=6),
+        util.Column("method",       width=-11),
+        util.Column("time",         ".5f"),
+        util.Column("max_err",      ".3e"),
+        util.Column("a_match"),
+    )
+    for t in t_list:
+        for depth in depth_list:
+            x_ref = None
+            for method, ema_func in reversed(METHODS.items()):
+                if (method == "loop") and (t * depth > max_loop_size):
+                    continue
+
+                with util.Timer(verbose=False) as timer:
+                    x = ema_func(t, depth, alpha)
+
+                a = get_threshold_times(x, threshold)
+                if x_ref is None:
+                    x_ref = x
+                    a_ref = a
+
+                table.update(
+                    t=t,
+                    depth=depth,
+                    method=method,
+                    time=timer.get_last(),
+                    max_err=np.abs(x - x_ref).max(),
+                    a_match=np.array_equal(a, a_ref),
+                )
+
+if __name__ == "__main__":
+    parser = cli.Parser(
+        cli.Arg("t",            type=int,   default=15000),
+        cli.Arg("depth",        type=int,   default=100),
+        cli.Arg("alpha",        type=float, default=0.01),
+        cli.Arg("threshold",    type=float, default=0.5),
+        cli.Arg(
+            "method",
+            type=str,
+            default="closed_form",
+            choices=list(METHODS.keys()),
+        ),
+        cli.Arg("benchmark",    action="store_true"),
+        cli.Arg("t_list",       type=int, nargs="+", default=[15000, 100000]),
+        cli.Arg("depth_list",   type=int, nargs="+", default=[100, 1000]),
+        cli.Arg("max_loop_size",    type=int, default=int(2e6)),
+    )
+    args = parser.parse_args()
+
+    if args.get_value("benchmark"):
+        benchmark(
+            t_list=args.get_value("t_list"),
+            depth_list=args.get_value("depth_list"),
+            alpha=args.get_value("alpha"),
+            threshold=args.get_value("threshold"),
+            max_loop_size=args.get_value("max_loop_size"),
+        )
+    else:
+        main(
+            t=args.get_value("t"),
+            depth=args.get_value("depth"),
+            alpha=args.get_value("alpha"),
+            threshold=args.get_value("threshold"),
+            method=args.get_value("method"),
+        )
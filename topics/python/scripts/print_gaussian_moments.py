@@ -5,19 +5,53 @@ import juml
 juml.test_utils.torch_set_print_options(threshold=int(1e9))
 torch.manual_seed(0)
 
+def estimate_moment(
+    d:          int,
+    n:          int,
+    chunk_size: int,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Estimate `E[v (v^T v) v^T]` for `v ~ N(0, I_d)` from `n` samples, returning
+    the mean and its standard error (both with shape `[d, d]`). Samples are
+    drawn `chunk_size` at a time, so peak memory is constant in `n`, and
+    `v (v^T v) v^T = ||v||^2 v v^T` is reduced over each chunk with one
+    `[d, chunk_size] @ [chunk_size, d]` product. Per-chunk sums are merged in
+    float64 using the parallel form of Welford's algorithm.
+    """
+    count = 0
+    mean = torch.zeros([d, d], dtype=torch.float64)
+    m2 = torch.zeros([d, d], dtype=torch.float64)
+    for i in range(0, n, chunk_size):
+        n_b = min(chunk_size, n - i)
+        v = torch.normal(0, 1, [n_b, d]).double()
+        v_sq = v.square()
+        s = v_sq.sum(dim=-1, keepdim=True)
+        mean_b = ((s * v).mT @ v) / n_b
+        m2_b = (s.square() * v_sq).mT @ v_sq - n_b * mean_b.square()
+
+        delta = mean_b - mean
+        mean += delta * (n_b / (count + n_b))
+        m2 += m2_b + delta.square() * (count * n_b / (count + n_b))
+        count += n_b
+
+    stderr = (m2 / (count * (count - 1))).sqrt()
+    return mean, stderr
+
+parser = cli.Parser(
+    cli.Arg("chunk_size", type=int, default=int(1e5)),
+)
+args = parser.parse_args()
+
 printer = util.Printer("print_gaussian_moments")
 print_tensor = juml.test_utils.TensorPrinter(printer)
 
 for d, n in [[5, 1e3], [20, 1e3], [5, 1e7], [10, 5e6], [20, 1e6]]:
     with util.Timer("print_gaussian_moments", printer, hline=True):
 
-        v = torch.normal(0, 1, [int(n), d, 1])
-
-        p = v @ (v.mT @ v) @ v.mT
-
-        pm = p.mean(dim=0)
+        pm, se = estimate_moment(d, int(n), args.get_value("chunk_size"))
 
         print_tensor(pm)
+        print_tensor(se)
 
     printer(3 + (d - 1))
 
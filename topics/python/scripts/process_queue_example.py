@@ -1,13 +1,282 @@
 import multiprocessing as mp
+import multiprocessing.connection
 import queue
+import heapq
+import os
 import time
 import datetime
+import traceback
+from jutility import util, cli
 
 def main(
+    args_list:          list,
+    devices:            list[int],
+    slots_per_device:   int=1,
+    max_retries:        int=2,
+    crash_job_ids:      (list[int] | None)=None,
+) -> tuple[float, list[dict]]:
+    """
+    Run every job in `args_list` on `devices`, longest job first. Each device
+    runs up to `slots_per_device` jobs at once, each slot being one worker
+    process. Jobs whose worker process dies are re-queued (up to
+    `max_retries` times) on a fresh worker. Returns the makespan in seconds,
+    and one record per attempt at each job (see `run_jobs_slot`).
+
+    `crash_job_ids` is only used to simulate crashes: the first attempt at
+    each of these jobs kills its worker process.
+    """
+    if crash_job_ids is None:
+        crash_job_ids = []
+
+    job_heap = [
+        Job(job_id, args, get_job_size(args))
+        for job_id, args in enumerate(args_list)
+    ]
+    heapq.heapify(job_heap)
+
+    print("%s [main]: Creating processes..." % datetime.datetime.now())
+    workers = [
+        Worker(device, slot, crash_job_ids)
+        for device in devices
+        for slot in range(slots_per_device)
+    ]
+    busy_time = {device: 0.0 for device in devices}
+    record_list = []
+    num_done = 0
+    t0 = time.perf_counter()
+
+    print("%s [main]: Starting jobs..." % datetime.datetime.now())
+    while len(job_heap) > 0 or any(w.job is not None for w in workers):
+        idle_workers = [w for w in workers if w.job is None]
+        while (len(idle_workers) > 0) and (len(job_heap) > 0):
+            w = min(idle_workers, key=lambda w: get_load(w.device, workers))
+            w.start(heapq.heappop(job_heap))
+            idle_workers.remove(w)
+
+        busy_workers = [w for w in workers if w.job is not None]
+        ready = mp.connection.wait(
+            [w.conn for w in busy_workers]
+            + [w.process.sentinel for w in busy_workers]
+        )
+        for w in busy_workers:
+            if (w.conn in ready) or (w.process.sentinel in ready):
+                job = w.job
+                busy_time[w.device] += w.finish()
+                try:
+                    record = w.conn.recv()
+                except EOFError:
+                    record = None
+
+                if record is None:
+                    w.process.join()
+                    record = job.get_record(w.device, w.t_start)
+                    record["status"] = "crashed"
+                    record["traceback"] = (
+                        "Worker process exited with code %s"
+                        % w.process.exitcode
+                    )
+                    w.restart()
+                    if job.attempt < max_retries:
+                        job.requeue()
+                        heapq.heappush(job_heap, job)
+                    else:
+                        num_done += 1
+                else:
+                    num_done += 1
+
+                record_list.append(record)
+                print(
+                    "%s [main]: Job %s %s on device %s (%i/%i jobs done)"
+                    % (
+                        datetime.datetime.now(),
+                        record["job_id"],
+                        record["status"],
+                        record["device"],
+                        num_done,
+                        len(args_list),
+                    )
+                )
+
+    for w in workers:
+        w.stop()
+
+    makespan = time.perf_counter() - t0
+    for device in devices:
+        utilisation = busy_time[device] / (makespan * slots_per_device)
+        print(
+            "%s [main]: Device %s utilisation = %.1f%%"
+            % (datetime.datetime.now(), device, 100 * utilisation)
+        )
+
+    print_summary(record_list, makespan)
+    print("%s [main]: End of main function" % datetime.datetime.now())
+    return makespan, record_list
+
+def print_summary(record_list: list[dict], makespan: float):
+    table = util.Table(
+        util.Column("job_id",       "i", width=5, title="Job"),
+        util.Column("args",         width=6),
+        util.Column("device",       "i", width=6),
+        util.Column("attempt",      "i", width=7),
+        util.Column("status",       width=-8),
+        util.Column("queue_delay",  ".3f", width=11),
+        util.Column("run_time",     ".3f"),
+        util.Column("result",       ".5f"),
+    )
+    for r in sorted(record_list, key=lambda r: (r["job_id"], r["attempt"])):
+        table.update(
+            job_id=r["job_id"],
+            args=r["args"],
+            device=r["device"],
+            attempt=r["attempt"],
+            status=r["status"],
+            queue_delay=(r["t_start"] - r["t_queued"]),
+            run_time=(r["t_end"] - r["t_start"]),
+            result=r["result"],
+        )
+
+    for r in record_list:
+        if r["traceback"] is not None:
+            print("\nJob %s, attempt %s:" % (r["job_id"], r["attempt"]))
+            print(r["traceback"])
+
+    num_finished = len([r for r in record_list if r["status"] == "finished"])
+    queue_delays = [r["t_start"] - r["t_queued"] for r in record_list]
+    print(
+        "%s [main]: Makespan = %.3fs, throughput = %.3f jobs/s, "
+        "mean queueing delay = %.3fs"
+        % (
+            datetime.datetime.now(),
+            makespan,
+            num_finished / makespan,
+            sum(queue_delays) / len(queue_delays),
+        )
+    )
+
+class Job:
+    def __init__(self, job_id: int, args, size: float):
+        self.job_id = job_id
+        self.args = args
+        self.size = size
+        self.attempt = 0
+        self.t_queued = time.time()
+
+    def requeue(self):
+        self.attempt += 1
+        self.t_queued = time.time()
+
+    def get_record(self, device: int, t_start: float) -> dict:
+        return {
+            "job_id":       self.job_id,
+            "args":         self.args,
+            "device":       device,
+            "attempt":      self.attempt,
+            "t_queued":     self.t_queued,
+            "t_start":      t_start,
+            "t_end":        time.time(),
+            "status":       "finished",
+            "result":       None,
+            "traceback":    None,
+        }
+
+    def __lt__(self, other: "Job"):
+        return (-self.size, self.job_id) < (-other.size, other.job_id)
+
+    def __repr__(self):
+        return util.format_type(
+            type(self),
+            job_id=self.job_id,
+            args=self.args,
+            attempt=self.attempt,
+        )
+
+class Worker:
+    def __init__(self, device: int, slot: int, crash_job_ids: list[int]):
+        self.device = device
+        self.slot = slot
+        self.crash_job_ids = crash_job_ids
+        self.job = None
+        self.conn = None
+        self.process = None
+        self.restart()
+
+    def restart(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.process.join()
+
+        self.conn, worker_conn = mp.Pipe()
+        self.process = mp.Process(
+            target=run_jobs_slot,
+            args=(self.device, worker_conn, self.crash_job_ids),
+            daemon=True,
+        )
+        self.process.start()
+        worker_conn.close()
+
+    def start(self, job: Job):
+        self.job = job
+        self.t_start = time.time()
+        self.conn.send(job)
+
+    def finish(self) -> float:
+        self.job = None
+        return time.time() - self.t_start
+
+    def stop(self):
+        self.conn.send(None)
+        self.process.join()
+
+def get_job_size(args: int) -> float:
+    return args
+
+def get_load(device: int, workers: list[Worker]) -> float:
+    return sum(
+        w.job.size
+        for w in workers
+        if (w.device == device) and (w.job is not None)
+    )
+
+def run_jobs_slot(
+    device:         int,
+    conn:           mp.connection.Connection,
+    crash_job_ids:  list[int],
+):
+    """
+    Run jobs received from `conn` until receiving `None`. After each job, send
+    back a record of the job with its start and end times, device, return
+    value, and the traceback of any exception raised by `train`.
+    """
+    while True:
+        job = conn.recv()
+        if job is None:
+            return
+
+        if (job.job_id in crash_job_ids) and (job.attempt == 0):
+            os._exit(1)
+
+        record = job.get_record(device, time.time())
+        try:
+            record["result"] = train(job.args, device)
+        except Exception:
+            record["status"] = "failed"
+            record["traceback"] = traceback.format_exc()
+
+        record["t_end"] = time.time()
+        conn.send(record)
+
+def main_fifo(
     args_list: list,
     devices: list[int],
-):
-    q = mp.Queue()
+) -> float:
+    """
+    FIFO polling baseline, in which each worker exits as soon as it finds
+    the queue empty. A manager queue is used because its `put` is
+    synchronous; with `mp.Queue` the workers can find the queue empty before
+    its feeder thread has flushed any jobs, and exit without running them.
+    """
+    manager = mp.Manager()
+    q = manager.Queue()
     for args in args_list:
         q.put(args)
 
@@ -18,17 +287,21 @@ def main(
     ]
 
     print("%s [main]: Starting jobs..." % datetime.datetime.now())
+    t0 = time.perf_counter()
     for p in p_list:
         p.start()
 
     for p in p_list:
         p.join()
 
+    makespan = time.perf_counter() - t0
+    manager.shutdown()
     print("%s [main]: End of main function" % datetime.datetime.now())
+    return makespan
 
 def run_jobs_gpu(
     device: int,
-    q: mp.Queue,
+    q: queue.Queue,
 ):
     while True:
         try:
@@ -40,13 +313,58 @@ def run_jobs_gpu(
 def train(
     args: int,
     device: int,
-):
+) -> float:
     timestamp = datetime.datetime.now()
     print("%s [train]: Device = %s, args = %s" % (timestamp, device, args))
+    if args < 0:
+        raise ValueError("Invalid args = %s" % args)
+
     time.sleep(args)
+    return 1 / (1 + args)
+
+def benchmark(time_scale: float):
+    workload = [1, 1, 1, 1, 1, 1, 4]
+    args_list = [time_scale * args for args in workload]
+    devices = [3, 7]
+    lower_bound = sum(args_list) / len(devices)
+
+    makespan_fifo = main_fifo(args_list, devices)
+    makespan, _ = main(args_list, devices)
+
+    table = util.Table(
+        util.Column("scheduler",    width=-20),
+        util.Column("makespan",     ".3f"),
+        util.Column("lower_bound",  ".3f"),
+    )
+    table.update(
+        scheduler="FIFO polling",
+        makespan=makespan_fifo,
+        lower_bound=lower_bound,
+    )
+    table.update(
+        scheduler="Longest job first",
+        makespan=makespan,
+        lower_bound=lower_bound,
+    )
 
 if __name__ == "__main__":
-    main(
-        args_list=[3, 2, 2, 3, 2],
-        devices=[3, 7],
+    parser = cli.Parser(
+        cli.Arg("benchmark",    action="store_true"),
+        cli.Arg("time_scale",   type=float, default=0.5),
+        cli.Arg("inject_faults", action="store_true"),
     )
+    args = parser.parse_args()
+
+    if args.get_value("benchmark"):
+        benchmark(args.get_value("time_scale"))
+    elif args.get_value("inject_faults"):
+        main(
+            args_list=[3, 2, 2, 3, 2, -1],
+            devices=[3, 7],
+            crash_job_ids=[1],
+        )
+    else:
+        main(
+            args_list=[3, 2, 2, 3, 2],
+            devices=[3, 7],
+        )
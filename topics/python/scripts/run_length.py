@@ -0,0 +1,260 @@
+import numpy as np
+import torch
+from jutility import util, cli
+
+def count_runs(
+    mask:       (np.ndarray | torch.Tensor),
+    axis:       int=-1,
+    initial:    (int | np.ndarray | torch.Tensor)=0,
+) -> (np.ndarray | torch.Tensor):
+    """
+    Return the length of the run of consecutive `True` values in `mask` which
+    ends at each position along `axis` (`0` wherever `mask` is `False`), for
+    NumPy arrays or torch tensors of any shape.
+
+    Each position is replaced by its index if `mask` is `False` there (a
+    reset), and the running maximum of these indices gives the index of the
+    most recent reset, so each count is its distance from the most recent
+    reset, in `O(n)` time. `initial` is the length of a run which is already
+    in progress before the first position, and can be a scalar or have the
+    shape of `mask` without `axis`.
+    """
+    if isinstance(mask, torch.Tensor):
+        m = mask.movedim(axis, -1)
+        idx = torch.arange(m.shape[-1], device=m.device)
+        start = -1 - torch.as_tensor(initial, device=m.device)
+        last_reset = torch.where(m, start[..., None], idx)
+        last_reset = torch.cummax(last_reset, dim=-1).values
+        counts = idx - last_reset
+        return counts.movedim(-1, axis)
+
+    m = np.moveaxis(mask, axis, -1)
+    idx = np.arange(m.shape[-1])
+    start = -1 - np.asarray(initial)
+    last_reset = np.where(m, start[..., None], idx)
+    np.maximum.accumulate(last_reset, axis=-1, out=last_reset)
+    np.subtract(idx, last_reset, out=last_reset)
+    return np.moveaxis(last_reset, -1, axis)
+
+def count_increases(
+    y:      (np.ndarray | torch.Tensor),
+    axis:   int=-1,
+) -> (np.ndarray | torch.Tensor):
+    """
+    Return the number of consecutive increases in `y` along `axis` which end
+    at each position.
+    """
+    return IncreaseCounter().update(y, axis)
+
+def count_no_min(
+    y:      (np.ndarray | torch.Tensor),
+    axis:   int=-1,
+) -> (np.ndarray | torch.Tensor):
+    """
+    Return the number of consecutive positions along `axis` since `y` last
+    reached a new minimum, EG the number of epochs without improvement to a
+    validation loss.
+    """
+    return NoMinCounter().update(y, axis)
+
+class RunLengthCounter:
+    """
+    Streaming form of `count_runs`, which can be updated with consecutive
+    chunks of a sequence (EG as new values arrive during training), with
+    results identical to calling `count_runs` on the whole sequence at once.
+    Subclasses override `get_mask` to count runs of other predicates of the
+    values passed to `update`, storing any state needed across chunks.
+    """
+    def __init__(self):
+        self.count = 0
+
+    def get_mask(
+        self,
+        y:      (np.ndarray | torch.Tensor),
+        axis:   int,
+    ) -> (np.ndarray | torch.Tensor):
+        return y
+
+    def update(
+        self,
+        y:      (np.ndarray | torch.Tensor),
+        axis:   int=-1,
+    ) -> (np.ndarray | torch.Tensor):
+        """
+        Return the counts for each position of the new chunk `y`, which has
+        the same shape as previous chunks except along `axis`. Empty chunks
+        leave the state unchanged.
+        """
+        if y.shape[axis] == 0:
+            return count_runs(y != y, axis)
+
+        counts = count_runs(self.get_mask(y, axis), axis, self.count)
+        self.count = take_last(counts, axis)
+        return counts
+
+class IncreaseCounter(RunLengthCounter):
+    def __init__(self):
+        super().__init__()
+        self.y_prev = None
+
+    def get_mask(
+        self,
+        y:      (np.ndarray | torch.Tensor),
+        axis:   int,
+    ) -> (np.ndarray | torch.Tensor):
+        if self.y_prev is None:
+            self.y_prev = take_first(y, axis)
+
+        if isinstance(y, torch.Tensor):
+            dy = torch.diff(y, dim=axis, prepend=self.y_prev.unsqueeze(axis))
+        else:
+            y_prev = np.expand_dims(self.y_prev, axis)
+            dy = np.diff(y, axis=axis, prepend=y_prev)
+
+        self.y_prev = take_last(y, axis)
+        return dy > 0
+
+class NoMinCounter(RunLengthCounter):
+    def __init__(self):
+        super().__init__()
+        self.best = None
+
+    def get_mask(
+        self,
+        y:      (np.ndarray | torch.Tensor),
+        axis:   int,
+    ) -> (np.ndarray | torch.Tensor):
+        if isinstance(y, torch.Tensor):
+            best = torch.cummin(y, dim=axis).values
+            if self.best is not None:
+                best = torch.minimum(best, self.best.unsqueeze(axis))
+        else:
+            best = np.minimum.accumulate(y, axis=axis)
+            if self.best is not None:
+                best = np.minimum(best, np.expand_dims(self.best, axis))
+
+        self.best = take_last(best, axis)
+        return y > best
+
+def take_first(
+    x:      (np.ndarray | torch.Tensor),
+    axis:   int,
+) -> (np.ndarray | torch.Tensor):
+    if isinstance(x, torch.Tensor):
+        return x.select(axis, 0)
+
+    return np.take(x, 0, axis=axis)
+
+def take_last(
+    x:      (np.ndarray | torch.Tensor),
+    axis:   int,
+) -> (np.ndarray | torch.Tensor):
+    if isinstance(x, torch.Tensor):
+        return x.select(axis, -1)
+
+    return np.take(x, -1, axis=axis)
+
+def update_in_chunks(
+    counter:    RunLengthCounter,
+    y:          np.ndarray,
+    num_chunks: int,
+) -> np.ndarray:
+    return np.concatenate(
+        [counter.update(y_chunk) for y_chunk in np.array_split(y, num_chunks)]
+    )
+
+def count_increases_loop(y: list[float]) -> list[int]:
+    counts = [0] * len(y)
+    for i in range(1, len(y)):
+        if y[i] > y[i - 1]:
+            counts[i] = counts[i - 1] + 1
+
+    return counts
+
+def count_no_min_loop(y: list[float]) -> list[int]:
+    counts = [0] * len(y)
+    best = y[0]
+    for i in range(1, len(y)):
+        if y[i] > best:
+            counts[i] = counts[i - 1] + 1
+        else:
+            best = y[i]
+
+    return counts
+
+def benchmark(
+    n_list:         list[int],
+    num_chunks:     int,
+    max_loop_size:  int,
+    seed:           int,
+):
+    """
+    Compare `count_increases` and `count_no_min` on random walks of length
+    `n` (as a NumPy array, a torch tensor, and in `num_chunks` chunks with
+    the streaming counters) against a Python loop over a list, which is only
+    run when `n <= max_loop_size`. Every vectorised result is checked against
+    the loop if it was run, and otherwise against the NumPy result.
+    """
+    counter_list = [
+        ("increases",   IncreaseCounter,    count_increases_loop),
+        ("no_min",      NoMinCounter,       count_no_min_loop),
+    ]
+    table = util.Table(
+        util.Column("counter",  width=-9),
+        util.Column("n",        "i", width=10),
+        util.Column("method",   width=-9),
+        util.Column("time",     ".4f"),
+        util.Column("speedup",  ".1f"),
+        util.Column("max_count", "i", width=9),
+        util.Column("correct"),
+    )
+    rng = np.random.default_rng(seed)
+    for n in n_list:
+        y = np.cumsum(rng.normal(size=n, scale=0.1).astype(np.float32))
+        y_torch = torch.from_numpy(y)
+        for counter_name, counter_type, loop_func in counter_list:
+            method_dict = dict()
+            if n <= max_loop_size:
+                y_list = y.tolist()
+                method_dict["loop"] = lambda: np.array(loop_func(y_list))
+
+            method_dict["numpy"] = lambda: counter_type().update(y)
+            method_dict["torch"] = lambda: counter_type().update(y_torch)
+            method_dict["stream"] = (
+                lambda: update_in_chunks(counter_type(), y, num_chunks)
+            )
+
+            c_ref = None
+            t_ref = None
+            for method, method_func in method_dict.items():
+                with util.Timer(verbose=False) as timer:
+                    c = method_func()
+
+                c = np.asarray(c)
+                if c_ref is None:
+                    c_ref = c
+                    t_ref = timer.get_last()
+
+                table.update(
+                    counter=counter_name,
+                    n=n,
+                    method=method,
+                    time=timer.get_last(),
+                    speedup=(t_ref / timer.get_last()),
+                    max_count=c.max(),
+                    correct=np.array_equal(c, c_ref),
+                )
+                del c
+
+if __name__ == "__main__":
+    parser = cli.Parser(
+        cli.Arg("n_list",           type=int, nargs="+",
+                default=[int(1e4), int(1e6), int(1e8)]),
+        cli.Arg("num_chunks",       type=int, default=10),
+        cli.Arg("max_loop_size",    type=int, default=int(1e7)),
+        cli.Arg("seed",             type=int, default=0),
+    )
+    args = parser.parse_args()
+
+    with util.Timer("benchmark"):
+        benchmark(**args.get_kwargs())
@@ -0,0 +1,33 @@
+import torch
+
+def run_trials(
+    lr:         torch.Tensor,
+    std:        torch.Tensor,
+    n_repeats:  int,
+    d:          int,
+    n_steps:    int,
+) -> torch.Tensor:
+    """
+    Simulate SGD on `0.5 * ||x||^2` from `x = 1`, with gradient noise drawn
+    from `N(0, std^2)`, for every pair of (`lr`, `std`) values (broadcast
+    against each other) and repeat at once. This is the batched version of
+    `run_trial` in `demo_sgd_noise_floor_vs_lr` and
+    `demo_sgd_noise_floor_vs_std`. Returns a tensor with shape `[n_steps + 1,
+    n_params, n_repeats]`.
+    """
+    lr, std = torch.broadcast_tensors(lr, std)
+    lr  = lr.reshape(-1, 1, 1)
+    std = std.reshape(-1, 1, 1)
+    n_params = lr.shape[0]
+
+    x = torch.ones([n_params, n_repeats, d])
+    eps = torch.empty([n_params, n_repeats, d])
+    y = torch.empty([n_steps + 1, n_params, n_repeats])
+    torch.sum(x.square(), dim=-1, out=y[0])
+
+    for t in range(n_steps):
+        eps.normal_().mul_(std).add_(x)
+        x.sub_(lr * eps)
+        torch.sum(x.square(), dim=-1, out=y[t + 1])
+
+    return y.mul_(0.5)
@@ -0,0 +1,144 @@
+import multiprocessing as mp
+import numpy as np
+import torch
+from jutility import util, cli
+
+def run_sweep(
+    trial_func,
+    param_name:     str,
+    param_list:     list[float],
+    n_repeats:      int,
+    num_workers:    int=0,
+    seed:           int=0,
+    **trial_kwargs,
+) -> list[list[list[float]]]:
+    """
+    Run `trial_func(**{param_name: param}, **trial_kwargs, generator=g)` for
+    every `param` in `param_list` and every repeat, and return the results
+    nested as `y[param_ind][repeat]`.
+
+    Each (parameter, repeat) cell uses its own `torch.Generator`, derived from
+    `seed` and the cell's indices by `get_generator`. Results are therefore
+    bit-identical whatever the value of `num_workers` (`0` means running every
+    cell in the current process) and whatever order the cells finish in.
+    """
+    cell_list = [
+        (trial_func, param_name, i, float(param), repeat, seed, trial_kwargs)
+        for i, param in enumerate(param_list)
+        for repeat in range(n_repeats)
+    ]
+    y = [[None] * n_repeats for _ in param_list]
+
+    if num_workers > 0:
+        with mp.Pool(
+            num_workers,
+            initializer=torch.set_num_threads,
+            initargs=(1,),
+        ) as pool:
+            for i, repeat, y_list in pool.imap_unordered(run_cell, cell_list):
+                y[i][repeat] = y_list
+    else:
+        for cell in cell_list:
+            i, repeat, y_list = run_cell(cell)
+            y[i][repeat] = y_list
+
+    return y
+
+def run_cell(cell: tuple) -> tuple[int, int, list[float]]:
+    trial_func, param_name, i, param, repeat, seed, trial_kwargs = cell
+    y_list = trial_func(
+        **{param_name: param},
+        **trial_kwargs,
+        generator=get_generator(seed, i, repeat),
+    )
+    return i, repeat, y_list
+
+def get_generator(seed: int, *spawn_key: int) -> torch.Generator:
+    """
+    Return a `torch.Generator` for the task identified by `spawn_key` (EG
+    `(param_ind, repeat)`), which is independent of the generator for every
+    other task derived from the same `seed`.
+    """
+    seed_seq = np.random.SeedSequence(seed, spawn_key=spawn_key)
+    [cell_seed] = seed_seq.generate_state(1, dtype=np.uint64)
+    return torch.Generator().manual_seed(int(cell_seed))
+
+def benchmark(
+    num_workers_list:   list[int],
+    n_param:            int,
+    n_repeats:          int,
+    d:                  int,
+    n_steps:            int,
+):
+    import demo_sgd_noise_floor_vs_lr
+    import demo_sgd_noise_floor_vs_std
+    import demo_sgd_variable_noise
+
+    sweep_list = [
+        (
+            "noise_floor_vs_lr",
+            demo_sgd_noise_floor_vs_lr.run_trial,
+            "lr",
+            util.log_range(0.01, 1, n_param),
+            {"std": 0.1},
+        ),
+        (
+            "noise_floor_vs_std",
+            demo_sgd_noise_floor_vs_std.run_trial,
+            "std",
+            util.log_range(0.01, 1, n_param),
+            {"lr": 0.01},
+        ),
+        (
+            "variable_noise",
+            demo_sgd_variable_noise.run_trial,
+            "lr",
+            util.log_range(0.01, 0.2, n_param),
+            {"k": 0.1},
+        ),
+    ]
+    table = util.Table(
+        util.Column("sweep",        width=-20),
+        util.Column("num_workers",  "i", width=11),
+        util.Column("time",         ".3f"),
+        util.Column("speedup",      ".2f"),
+        util.Column("identical"),
+    )
+    for sweep_name, trial_func, param_name, param_list, kwargs in sweep_list:
+        y_serial = None
+        for num_workers in [0, *num_workers_list]:
+            with util.Timer(verbose=False) as timer:
+                y = run_sweep(
+                    trial_func,
+                    param_name,
+                    param_list,
+                    n_repeats,
+                    num_workers,
+                    d=d,
+                    n_steps=n_steps,
+                    **kwargs,
+                )
+            if y_serial is None:
+                y_serial = y
+                t_serial = timer.get_last()
+
+            table.update(
+                sweep=sweep_name,
+                num_workers=num_workers,
+                time=timer.get_last(),
+                speedup=(t_serial / timer.get_last()),
+                identical=(y == y_serial),
+            )
+
+if __name__ == "__main__":
+    parser = cli.Parser(
+        cli.Arg("num_workers_list", type=int, default=[1, 2, 4], nargs="+"),
+        cli.Arg("n_param",          type=int, default=10),
+        cli.Arg("n_repeats",        type=int, default=10),
+        cli.Arg("d",                type=int, default=100),
+        cli.Arg("n_steps",          type=int, default=1000),
+    )
+    args = parser.parse_args()
+
+    with util.Timer("benchmark"):
+        benchmark(**args.get_kwargs())
@@ -1,5 +1,9 @@
+import itertools
+import resource
+import multiprocessing as mp
 import torch
 import juml
+from jutility import util, cli
 
 def blockwise_matrix_softmax(
     x_io:   torch.Tensor,
@@ -17,22 +21,260 @@ def blockwise_matrix_softmax(
     y_io    =     y_jbkd.reshape(d1*b1, d2*b2)
     return y_io
 
-torch.manual_seed(0)
-juml.test_utils.torch_set_print_options(precision=5)
+class BlockwiseMatrixSoftmax(torch.autograd.Function):
+    """
+    Softmax over each `[b1, b2]` block of a tensor with shape `[*B, d1*b1,
+    d2*b2]`. The input is viewed as `[*B, d1, b1, d2, b2]` (splitting
+    dimensions never copies), and every reduction is over the block axes `b1`
+    and `b2` of this view, so the only full-size tensor allocated is the
+    output. Reducing over `b1` and then `b2` is faster than one reduction over
+    both axes, especially for small blocks, because the first reduction
+    combines whole contiguous rows elementwise (at the cost of intermediate
+    tensors `1 / b1` times the size of the input). The backward pass reuses the
+    saved output, and allocates one full-size tensor for the gradient.
+    """
+    @staticmethod
+    def forward(
+        ctx,
+        x:  torch.Tensor,
+        d1: int,
+        b1: int,
+        d2: int,
+        b2: int,
+    ) -> torch.Tensor:
+        x_jbkd = x.unflatten(-1, [d2, b2]).unflatten(-3, [d1, b1])
+        m_j1kd = x_jbkd.amax(dim=-3, keepdim=True)
+        m_j1k1 = m_j1kd.amax(dim=-1, keepdim=True)
+        y_jbkd = torch.sub(x_jbkd, m_j1k1).exp_()
+        y_jbkd.div_(block_sum(y_jbkd))
+        ctx.save_for_backward(y_jbkd)
+        return y_jbkd.flatten(-2, -1).flatten(-3, -2)
 
-d1 = 5
-b1 = 2
-d2 = 4
-b2 = 3
+    @staticmethod
+    def backward(ctx, dl_dy: torch.Tensor):
+        [y_jbkd] = ctx.saved_tensors
+        g_jbkd = dl_dy.reshape(y_jbkd.shape) * y_jbkd
+        g_jbkd.addcmul_(y_jbkd, block_sum(g_jbkd), value=-1)
+        dl_dx = g_jbkd.flatten(-2, -1).flatten(-3, -2)
+        return dl_dx, None, None, None, None
 
-x_io = torch.normal(0, 1, [d1*b1, d2*b2])
-y_io = blockwise_matrix_softmax(x_io, d1, b1, d2, b2)
+def block_sum(x_jbkd: torch.Tensor) -> torch.Tensor:
+    return x_jbkd.sum(dim=-3, keepdim=True).sum(dim=-1, keepdim=True)
 
-print(x_io)
-print(y_io)
+def blockwise_matrix_softmax_batched(
+    x:  torch.Tensor,
+    d1: int,
+    b1: int,
+    d2: int,
+    b2: int,
+) -> torch.Tensor:
+    return BlockwiseMatrixSoftmax.apply(x, d1, b1, d2, b2)
 
-i = 3
-j = 1
-print(i, j)
-print(y_io[i*b1:i*b1+b1, j*b2:j*b2+b2])
-print(y_io[i*b1:i*b1+b1, j*b2:j*b2+b2].sum())
+def check_correctness(max_block_dim: int, seed: int):
+    """
+    Compare `blockwise_matrix_softmax_batched` against
+    `blockwise_matrix_softmax` (applied to each matrix in the batch in turn)
+    for every combination of `d1, b1, d2, b2` in `[1, max_block_dim]` and
+    several batch shapes, for both outputs and gradients, on inputs with
+    large entries which would overflow `exp` without subtracting the block
+    maximum. Also run `gradcheck` on a small case in `float64`.
+    """
+    torch.manual_seed(seed)
+    dim_range = range(1, max_block_dim + 1)
+    batch_shape_list = [[], [3], [2, 3]]
+    num_cases = 0
+    max_y_err = 0
+    max_g_err = 0
+    for d1, b1, d2, b2 in itertools.product(dim_range, repeat=4):
+        for batch_shape in batch_shape_list:
+            shape = [*batch_shape, d1*b1, d2*b2]
+            x = torch.normal(0, 100, shape, dtype=torch.float64)
+            dl_dy = torch.normal(0, 1, shape, dtype=torch.float64)
+
+            x1 = x.clone().requires_grad_(True)
+            y1 = torch.stack(
+                [
+                    blockwise_matrix_softmax(xi, d1, b1, d2, b2)
+                    for xi in x1.reshape(-1, d1*b1, d2*b2)
+                ]
+            ).reshape(shape)
+            y1.backward(dl_dy)
+
+            x2 = x.clone().requires_grad_(True)
+            y2 = blockwise_matrix_softmax_batched(x2, d1, b1, d2, b2)
+            y2.backward(dl_dy)
+
+            assert y2.shape == y1.shape
+            assert y2.isfinite().all()
+            max_y_err = max(max_y_err, (y2 - y1).abs().max().item())
+            max_g_err = max(max_g_err, (x2.grad - x1.grad).abs().max().item())
+            num_cases += 1
+
+    x = torch.normal(0, 1, [2, 3*2, 2*3], dtype=torch.float64)
+    gradcheck_passed = torch.autograd.gradcheck(
+        blockwise_matrix_softmax_batched,
+        (x.requires_grad_(True), 3, 2, 2, 3),
+    )
+
+    print("Cases checked: %i" % num_cases)
+    print("Max output error: %.3e" % max_y_err)
+    print("Max gradient error: %.3e" % max_g_err)
+    print("gradcheck passed: %s" % gradcheck_passed)
+    assert max_y_err < 1e-12
+    assert max_g_err < 1e-12
+
+def blockwise_matrix_softmax_loop(
+    x:  torch.Tensor,
+    d1: int,
+    b1: int,
+    d2: int,
+    b2: int,
+) -> torch.Tensor:
+    return torch.stack(
+        [blockwise_matrix_softmax(xi, d1, b1, d2, b2) for xi in x]
+    )
+
+IMPLS = {
+    "original": blockwise_matrix_softmax_loop,
+    "batched":  blockwise_matrix_softmax_batched,
+}
+
+def benchmark(
+    batch_size:     int,
+    n:              int,
+    block_list:     list[int],
+    num_reps:       int,
+    seed:           int,
+):
+    """
+    Time the forward pass, and the forward and backward passes, of both
+    implementations on `batch_size` matrices with shape `[n, n]` split into
+    `[b, b]` blocks for each `b` in `block_list`. The original implementation
+    only accepts a single matrix, so it is applied to each matrix in the
+    batch in turn. Each case runs in a new process (see `time_impl`), so that
+    memory freed by previous cases can't hide the peak memory of later ones.
+    """
+    table = util.Table(
+        util.Column("impl",         width=-8),
+        util.Column("block",        "i", width=5),
+        util.Column("backward"),
+        util.Column("time",         ".4f"),
+        util.Column("speedup",      ".2f"),
+        util.Column("peak_mb",      ".1f", width=8),
+    )
+    ctx = mp.get_context("spawn")
+    for b in block_list:
+        for backward in [False, True]:
+            t_ref = None
+            for impl_name in IMPLS:
+                args = (impl_name, batch_size, n, b, backward, num_reps, seed)
+                with ctx.Pool(1) as pool:
+                    t, peak_mb = pool.apply(time_impl, args)
+
+                if t_ref is None:
+                    t_ref = t
+
+                table.update(
+                    impl=impl_name,
+                    block=b,
+                    backward=backward,
+                    time=t,
+                    speedup=(t_ref / t),
+                    peak_mb=peak_mb,
+                )
+
+    print("Input size = %.1f MB" % (batch_size * n * n * 4 / 2**20))
+
+def get_max_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def time_impl(
+    impl_name:  str,
+    batch_size: int,
+    n:          int,
+    b:          int,
+    backward:   bool,
+    num_reps:   int,
+    seed:       int,
+) -> tuple[float, float]:
+    """
+    Return the fastest of `num_reps` timed calls, and the increase in peak
+    resident memory (in MB) during the first call, before any memory has been
+    freed and could be reused by the allocator. This runs in a new process, in
+    which the peak before the first call is the memory used by the inputs.
+    """
+    torch.manual_seed(seed)
+    impl = IMPLS[impl_name]
+    d = n // b
+    x = torch.normal(0, 1, [batch_size, n, n]).requires_grad_(backward)
+    dl_dy = torch.normal(0, 1, [batch_size, n, n])
+
+    time_list = []
+    peak_mb = None
+    for _ in range(num_reps + 1):
+        max_rss_0 = get_max_rss_mb()
+        with util.Timer(verbose=False) as timer:
+            y = impl(x, d, b, d, b)
+            if backward:
+                y.backward(dl_dy)
+
+        if peak_mb is None:
+            peak_mb = get_max_rss_mb() - max_rss_0
+        else:
+            time_list.append(timer.get_last())
+
+        del y
+        x.grad = None
+
+    return min(time_list), peak_mb
+
+def main():
+    juml.test_utils.torch_set_print_options(precision=5)
+
+    d1 = 5
+    b1 = 2
+    d2 = 4
+    b2 = 3
+
+    x_io = torch.normal(0, 1, [d1*b1, d2*b2])
+    y_io = blockwise_matrix_softmax(x_io, d1, b1, d2, b2)
+
+    print(x_io)
+    print(y_io)
+
+    i = 3
+    j = 1
+    print(i, j)
+    print(y_io[i*b1:i*b1+b1, j*b2:j*b2+b2])
+    print(y_io[i*b1:i*b1+b1, j*b2:j*b2+b2].sum())
+
+if __name__ == "__main__":
+    parser = cli.Parser(
+        cli.Arg("benchmark",        action="store_true"),
+        cli.Arg("max_block_dim",    type=int, default=4),
+        cli.Arg("batch_size",       type=int, default=16),
+        cli.Arg("n",                type=int, default=2048),
+        cli.Arg("block_list",       type=int, nargs="+",
+                default=[2, 8, 32, 128]),
+        cli.Arg("num_reps",         type=int, default=5),
+        cli.Arg("seed",             type=int, default=0),
+    )
+    args = parser.parse_args()
+
+    torch.manual_seed(args.get_value("seed"))
+    main()
+
+    with util.Timer("check_correctness"):
+        check_correctness(
+            max_block_dim=args.get_value("max_block_dim"),
+            seed=args.get_value("seed"),
+        )
+
+    if args.get_value("benchmark"):
+        benchmark(
+            batch_size=args.get_value("batch_size"),
+            n=args.get_value("n"),
+            block_list=args.get_value("block_list"),
+            num_reps=args.get_value("num_reps"),
+            seed=args.get_value("seed"),
+        )
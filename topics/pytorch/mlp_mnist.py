@@ -1,11 +1,19 @@
 import os
+import copy
+import math
+import itertools
+import socket
+import resource
+import threading
+import concurrent.futures
 import numpy as np
 import torch
 import torch.utils.data
 import torchvision
-from jutility import util, plotting
+from jutility import util, plotting, cli
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+MNIST_TENSORS = dict()
 
 class Model(torch.nn.Module):
     def forward(self, x: torch.Tensor) -> torch.Tensor:
@@ -59,6 +67,123 @@ def get_data_loader(train=True, batch_size=100):
     )
     return data_loader
 
+class TensorDataLoader:
+    def __init__(
+        self,
+        x:          torch.Tensor,
+        t:          torch.Tensor,
+        batch_size: int=100,
+        shuffle:    bool=True,
+        seed:       int=0,
+    ):
+        self.x = x
+        self.t = t
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.generator = torch.Generator().manual_seed(seed)
+        self.epoch_rng_state = self.generator.get_state()
+        self.start_batch = 0
+        self.shard(rank=0, world_size=1)
+
+    @classmethod
+    def from_mnist(cls, train=True, batch_size=100, shuffle=True):
+        x, t = load_mnist_tensors(train)
+        return cls(x, t, batch_size, shuffle)
+
+    def shard(self, rank: int, world_size: int):
+        """
+        Only iterate over every `world_size`th sample (after shuffling),
+        starting from `rank`. Every shard has the same number of samples, so
+        that all data-parallel workers take the same number of steps.
+        """
+        self.rank = rank
+        self.world_size = world_size
+        self.shard_size = len(self.t) // world_size
+
+    def resume(self, rng_state: torch.Tensor, start_batch: int):
+        """
+        Make the next epoch repeat the shuffle drawn from `rng_state`, and
+        skip the first `start_batch` batches of that epoch.
+        """
+        self.generator.set_state(rng_state)
+        self.start_batch = start_batch
+
+    def get_batch(self, inds: (torch.Tensor | slice)):
+        x = self.x[inds].to(torch.float32).div_(255)
+        t = self.t[inds].to(torch.int64)
+        return x, t
+
+    def __iter__(self):
+        self.epoch_rng_state = self.generator.get_state()
+        start = self.start_batch * self.batch_size
+        self.start_batch = 0
+
+        n = self.shard_size
+        if self.shuffle:
+            perm = torch.randperm(len(self.t), generator=self.generator)
+            inds = perm[self.rank::self.world_size]
+            for i in range(start, n, self.batch_size):
+                yield self.get_batch(inds[i:min(i+self.batch_size, n)])
+        else:
+            ws = self.world_size
+            for i in range(start, n, self.batch_size):
+                j = min(i+self.batch_size, n)
+                yield self.get_batch(slice(self.rank + i*ws, j*ws, ws))
+
+    def __len__(self):
+        return math.ceil(self.shard_size / self.batch_size)
+
+def load_mnist_tensors(train=True) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Decode the MNIST IDX files once into flattened contiguous `uint8` arrays
+    cached as `.npy` files, and memory-map the cached arrays the first time
+    they are needed in each process (unless `MNIST_TENSORS` has already been
+    filled in, EG with tensors in shared memory). Returns `x` with shape
+    `[n, 784]` and `t` with shape `[n]`.
+    """
+    if train in MNIST_TENSORS:
+        return MNIST_TENSORS[train]
+
+    split = "train" if train else "test"
+    cache_dir = os.path.join(CURRENT_DIR, "MNIST", "tensor_cache")
+    x_path = os.path.join(cache_dir, "%s_x.npy" % split)
+    t_path = os.path.join(cache_dir, "%s_t.npy" % split)
+
+    if not (os.path.isfile(x_path) and os.path.isfile(t_path)):
+        dataset = torchvision.datasets.MNIST(
+            root=CURRENT_DIR,
+            train=train,
+            download=True,
+        )
+        os.makedirs(cache_dir, exist_ok=True)
+        save_npy(dataset.data.flatten(1).contiguous().numpy(), x_path)
+        save_npy(dataset.targets.to(torch.uint8).numpy(), t_path)
+
+    x = torch.from_numpy(np.load(x_path, mmap_mode="c"))
+    t = torch.from_numpy(np.load(t_path, mmap_mode="c"))
+    MNIST_TENSORS[train] = (x, t)
+    return x, t
+
+def save_npy(array: np.ndarray, full_path: str):
+    tmp_path = full_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+
+    os.replace(tmp_path, full_path)
+
+def get_train_test_loaders(data: str, batch_size: int):
+    if data == "tensor":
+        train_loader = TensorDataLoader.from_mnist(True,  batch_size)
+        test_loader  = TensorDataLoader.from_mnist(False, batch_size)
+    elif data == "torchvision":
+        train_loader = get_data_loader(True,  batch_size)
+        test_loader  = get_data_loader(False, batch_size)
+    else:
+        raise ValueError("Unknown data loader %r" % data)
+
+    return train_loader, test_loader
+
+@torch.inference_mode()
 def get_accuracy(model, data_loader):
     num_samples = 0
     num_correct = 0
@@ -70,21 +195,188 @@ def get_accuracy(model, data_loader):
 
     return num_correct / num_samples
 
-def plot_metrics(table: util.Table, plot_name, output_dir, **kwargs):
+class StreamingAccuracy:
+    """
+    Running accuracy of the logits produced by the training steps since the
+    last call to `reset`. The model changes between batches, so this is an
+    estimate of the train accuracy which costs no extra forward passes.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.num_samples = 0
+        self.num_correct = torch.zeros([], dtype=torch.int64)
+
+    @torch.no_grad()
+    def update(self, y: torch.Tensor, t: torch.Tensor):
+        self.num_samples += t.numel()
+        self.num_correct += (y.argmax(dim=-1) == t).sum()
+
+    def get_accuracy(self) -> float:
+        return self.num_correct.item() / self.num_samples
+
+class Evaluator:
+    def __init__(
+        self,
+        model:          Model,
+        eval_batch_size: int,
+        full_train_acc: bool,
+    ):
+        self.model = model
+        self.train_loader = TensorDataLoader.from_mnist(
+            train=True,
+            batch_size=eval_batch_size,
+            shuffle=False,
+        )
+        self.test_loader = TensorDataLoader.from_mnist(
+            train=False,
+            batch_size=eval_batch_size,
+            shuffle=False,
+        )
+        self.full_train_acc = full_train_acc
+        self.train_acc = StreamingAccuracy()
+        self.timer = util.Timer(verbose=False)
+
+    def get_metrics(self) -> dict:
+        with self.timer:
+            if self.full_train_acc or (self.train_acc.num_samples == 0):
+                train_acc = get_accuracy(self.model, self.train_loader)
+            else:
+                train_acc = self.train_acc.get_accuracy()
+
+            test_acc = get_accuracy(self.model, self.test_loader)
+
+        self.train_acc.reset()
+        return {
+            "train_acc":    train_acc,
+            "test_acc":     test_acc,
+            "eval_time":    self.timer.get_last(),
+        }
+
+class CheckpointWriter:
+    """
+    Write checkpoints atomically from a background thread. `save` copies the
+    state on the calling thread and returns without waiting for the disk. If
+    a previous write is still in progress, only the newest pending checkpoint
+    is kept.
+    """
+    def __init__(self, full_path: str):
+        dir_name = os.path.dirname(os.path.abspath(full_path))
+        os.makedirs(dir_name, exist_ok=True)
+
+        self.full_path = full_path
+        self._pending = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def save(self, **state):
+        state = copy.deepcopy(state)
+        with self._condition:
+            self._pending = state
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+        self._thread.join()
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                while (self._pending is None) and (not self._closed):
+                    self._condition.wait()
+                if self._pending is None:
+                    return
+
+                state = self._pending
+                self._pending = None
+
+            tmp_path = self.full_path + ".tmp"
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, self.full_path)
+
+def get_train_step(
+    model:      Model,
+    optimiser:  torch.optim.Optimizer,
+    compiled:   bool,
+    precision:  str="float32",
+):
+    if precision not in ["float32", "bfloat16"]:
+        raise ValueError("Unknown precision %r" % precision)
+
+    use_autocast = (precision == "bfloat16")
+
+    def train_step(x: torch.Tensor, t: torch.Tensor):
+        with torch.autocast("cpu", torch.bfloat16, enabled=use_autocast):
+            y = model.forward(x)
+
+        loss = torch.nn.functional.cross_entropy(y.float(), t)
+        optimiser.zero_grad()
+        loss.backward()
+        optimiser.step()
+        return y, loss
+
+    if compiled:
+        train_step = torch.compile(train_step)
+
+    return train_step
+
+def plot_metrics(
+    table:      (util.Table | dict[str, util.Table]),
+    plot_name:  str,
+    output_dir: str,
+    **kwargs,
+):
     kwargs.setdefault("title", plot_name)
-    kwargs.setdefault("figsize", [10, 4])
     kwargs.setdefault("top_space", 0.2)
+    if isinstance(table, util.Table):
+        kwargs.setdefault("figsize", [10, 4])
+        loss_lines = [plotting.Line(table.get_data("batch_loss"))]
+        acc_lines = [
+            plotting.Line(table.get_data("train_acc"), c="b", label="Train"),
+            plotting.Line(table.get_data("test_acc"),  c="r", label="Test"),
+            plotting.Legend(),
+        ]
+    else:
+        cp = plotting.ColourPicker(len(table))
+        loss_lines = [
+            plotting.Line(t.get_data("batch_loss"), c=c, alpha=0.5)
+            for t, c in zip(table.values(), cp)
+        ]
+        acc_lines = [
+            plotting.Line(t.get_data(name), c=c, ls=ls)
+            for t, c in zip(table.values(), cp)
+            for name, ls in [["train_acc", "--"], ["test_acc", "-"]]
+        ]
+        kwargs.setdefault("figsize", [15, 4])
+        kwargs.setdefault(
+            "legend",
+            plotting.FigureLegend(
+                *[
+                    plotting.Line(c=c, label=name)
+                    for name, c in zip(table.keys(), cp)
+                ],
+                plotting.Line(c="k", ls="--", label="Train"),
+                plotting.Line(c="k", ls="-",  label="Test"),
+                num_rows=None,
+                loc="outside right",
+            ),
+        )
+
     mp = plotting.MultiPlot(
         plotting.Subplot(
-            plotting.Line(table.get_data("batch_loss")),
+            *loss_lines,
             xlabel="Batch",
             ylabel="Loss",
             title="Loss curve",
         ),
         plotting.Subplot(
-            plotting.Line(table.get_data("train_acc"), c="b", label="Train"),
-            plotting.Line(table.get_data("test_acc"),  c="r", label="Test"),
-            plotting.Legend(),
+            *acc_lines,
             xlabel="Epoch",
             ylabel="Accuracy",
             ylim=[0, 1],
@@ -94,57 +386,545 @@ def plot_metrics(table: util.Table, plot_name, output_dir, **kwargs):
     )
     mp.save(plot_name, output_dir)
 
-def main():
+def benchmark_data(batch_size: int, num_epochs: int):
+    table = util.Table(
+        util.TimeColumn(),
+        util.Column("data",         width=-11),
+        util.Column("epoch"),
+        util.Column("samples",      "i"),
+        util.Column("time",         ".5f"),
+        util.Column("samples_per_second", ".1f", title="Samples/s"),
+    )
+    timer = util.Timer(verbose=False)
+
+    for data in ["torchvision", "tensor"]:
+        train_loader, _ = get_train_test_loaders(data, batch_size)
+        for epoch in range(num_epochs):
+            num_samples = 0
+            with timer:
+                for x, t in train_loader:
+                    num_samples += t.numel()
+
+            table.update(
+                data=data,
+                epoch=epoch,
+                samples=num_samples,
+                time=timer.get_last(),
+                samples_per_second=num_samples/timer.get_last(),
+            )
+
+def benchmark_compile(
+    batch_size:             int,
+    hidden_dim_list:        list[int],
+    num_hidden_layers_list: list[int],
+    num_warmup_steps:       int,
+    num_timed_steps:        int,
+):
     torch.manual_seed(0)
+    x, t = TensorDataLoader.from_mnist(batch_size=batch_size).get_batch(
+        slice(0, batch_size),
+    )
 
-    train_loader = get_data_loader(train=True)
-    test_loader  = get_data_loader(train=False)
+    table = util.Table(
+        util.Column("hidden_dim",   "i"),
+        util.Column("num_hidden_layers", "i", title="Layers"),
+        util.Column("mode",         width=-8),
+        util.Column("warmup_time",  ".5f", width=11),
+        util.Column("latency_ms",   ".5f", width=10, title="Latency/ms"),
+        util.Column("steps_per_second", ".1f", width=10, title="Steps/s"),
+        util.Column("speedup",      ".3f"),
+    )
+    timer = util.Timer(verbose=False)
+
+    for hidden_dim in hidden_dim_list:
+        for num_hidden_layers in num_hidden_layers_list:
+            eager_latency = None
+            for compiled in [False, True]:
+                model = Mlp(784, 10, hidden_dim, num_hidden_layers)
+                optimiser = torch.optim.Adam(model.parameters(), lr=1e-3)
+                train_step = get_train_step(model, optimiser, compiled)
+
+                with timer:
+                    for _ in range(num_warmup_steps):
+                        train_step(x, t)
+
+                warmup_time = timer.get_last()
+
+                with timer:
+                    for _ in range(num_timed_steps):
+                        train_step(x, t)
+
+                latency = timer.get_last() / num_timed_steps
+                if not compiled:
+                    eager_latency = latency
+
+                table.update(
+                    hidden_dim=hidden_dim,
+                    num_hidden_layers=num_hidden_layers,
+                    mode=("compiled" if compiled else "eager"),
+                    warmup_time=warmup_time,
+                    latency_ms=1e3*latency,
+                    steps_per_second=1/latency,
+                    speedup=eager_latency/latency,
+                )
+
+            torch._dynamo.reset()
+
+def train(
+    data:               str,
+    batch_size:         int,
+    num_epochs:         int,
+    eval_batch_size:    int,
+    full_train_acc:     bool,
+    compiled:           bool,
+    precision:          str,
+    hidden_dim:         int,
+    num_hidden_layers:  int,
+    lr:                 float,
+    checkpoint_path:    (str | None),
+    checkpoint_interval: float,
+    rank:               int=0,
+    world_size:         int=1,
+    printer:            (util.Printer | None)=None,
+):
+    torch.manual_seed(0)
+
+    worker_batch_size = math.ceil(batch_size / world_size)
+    train_loader, _ = get_train_test_loaders(data, worker_batch_size)
+    if world_size > 1:
+        if not isinstance(train_loader, TensorDataLoader):
+            raise ValueError("Data-parallel training requires --data tensor")
+
+        train_loader.shard(rank, world_size)
+
+    checkpoint = None
+    if checkpoint_path is not None:
+        if not isinstance(train_loader, TensorDataLoader):
+            raise ValueError("Checkpointing requires --data tensor")
+        if os.path.isfile(checkpoint_path):
+            checkpoint = torch.load(checkpoint_path, weights_only=False)
 
     model = Mlp(
         input_dim=784,
         output_dim=10,
-        # num_hidden_layers=3,
-        # hidden_dim=1000,
-        num_hidden_layers=2,
-        hidden_dim=100,
+        num_hidden_layers=num_hidden_layers,
+        hidden_dim=hidden_dim,
+    )
+    if checkpoint is not None:
+        model.load_state_dict(checkpoint["model"])
+
+    train_model = model
+    if world_size > 1:
+        train_model = torch.nn.parallel.DistributedDataParallel(model)
+
+    optimiser = torch.optim.Adam(model.parameters(), lr=lr)
+    train_step = get_train_step(train_model, optimiser, compiled, precision)
+
+    start_epoch = 0
+    start_batch = 0
+    if checkpoint is not None:
+        optimiser.load_state_dict(checkpoint["optimiser"])
+        torch.set_rng_state(checkpoint["rng_state"])
+        start_epoch = checkpoint["epoch"]
+        start_batch = checkpoint["batch"]
+        train_loader.resume(checkpoint["loader_rng_state"], start_batch)
+
+    is_main = (rank == 0)
+    if is_main:
+        evaluator = Evaluator(model, eval_batch_size, full_train_acc)
+        if checkpoint is not None:
+            table = checkpoint["table"]
+            table.set_printer(printer if printer else util.Printer())
+            table.get_column("t").get_timer().set_time(table.get_data("t")[-1])
+            evaluator.train_acc = checkpoint["train_acc"]
+            print(
+                "Resuming from \"%s\" at epoch %i, batch %i"
+                % (checkpoint_path, start_epoch, start_batch)
+            )
+        else:
+            table = util.Table(
+                util.TimeColumn("t", width=-11),
+                util.Column("epoch"),
+                util.Column("batch"),
+                util.Column("batch_loss", ".5f", width=10),
+                util.Column("train_acc",  ".5f", width=10),
+                util.Column("test_acc",   ".5f", width=10),
+                util.Column("train_time", ".5f", width=10),
+                util.Column("eval_time",  ".5f", width=10),
+                util.Column("samples_per_second", ".1f", title="Samples/s"),
+                printer=printer,
+                print_interval=util.TimeInterval(1),
+            )
+            table.update(level=1, epoch=0, **evaluator.get_metrics())
+    else:
+        table = None
+
+    writer = None
+    checkpoint_timer = None
+    if is_main and (checkpoint_path is not None):
+        writer = CheckpointWriter(checkpoint_path)
+        if checkpoint_interval > 0:
+            checkpoint_timer = util.TimeInterval(checkpoint_interval)
+            checkpoint_timer.reset()
+
+    train_timer = util.Timer(verbose=False)
+    for epoch in range(start_epoch, num_epochs):
+        first_batch = start_batch if (epoch == start_epoch) else 0
+        num_samples = 0
+        with train_timer:
+            for i, (x, t) in enumerate(train_loader, first_batch):
+                y, loss = train_step(x, t)
+                num_samples += t.numel() * world_size
+                if is_main:
+                    evaluator.train_acc.update(y, t)
+                    table.update(epoch=epoch, batch=i, batch_loss=loss.item())
+
+                if (
+                    (checkpoint_timer is not None)
+                    and checkpoint_timer.ready()
+                    and (i + 1 < len(train_loader))
+                ):
+                    writer.save(
+                        model=model.state_dict(),
+                        optimiser=optimiser.state_dict(),
+                        epoch=epoch,
+                        batch=i + 1,
+                        loader_rng_state=train_loader.epoch_rng_state,
+                        rng_state=torch.get_rng_state(),
+                        table=table,
+                        train_acc=evaluator.train_acc,
+                    )
+                    checkpoint_timer.reset()
+
+        if is_main:
+            table.print_last()
+            table.update(
+                level=1,
+                epoch=epoch + 1,
+                train_time=train_timer.get_last(),
+                samples_per_second=num_samples/train_timer.get_last(),
+                **evaluator.get_metrics(),
+            )
+
+        if writer is not None:
+            writer.save(
+                model=model.state_dict(),
+                optimiser=optimiser.state_dict(),
+                epoch=epoch + 1,
+                batch=0,
+                loader_rng_state=train_loader.generator.get_state(),
+                rng_state=torch.get_rng_state(),
+                table=table,
+                train_acc=evaluator.train_acc,
+            )
+
+    if writer is not None:
+        writer.close()
+
+    return table, model
+
+def get_summary(table: util.Table) -> dict:
+    return {
+        "samples_per_second":   np.mean(table.get_data("samples_per_second")),
+        "test_acc":             table.get_data("test_acc")[-1],
+    }
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def train_worker(
+    rank:           int,
+    world_size:     int,
+    num_threads:    int,
+    port:           int,
+    results_queue,
+    kwargs:         dict,
+):
+    torch.distributed.init_process_group(
+        backend="gloo",
+        init_method="tcp://127.0.0.1:%i" % port,
+        rank=rank,
+        world_size=world_size,
+    )
+    torch.set_num_threads(num_threads)
+
+    table, model = train(rank=rank, world_size=world_size, **kwargs)
+    if rank == 0:
+        plot_name = "Metrics for %s (workers = %i)" % (model, world_size)
+        plot_metrics(table, plot_name, os.path.join(CURRENT_DIR, "img"))
+        results_queue.put(get_summary(table))
+
+    torch.distributed.destroy_process_group()
+
+def train_data_parallel(num_workers: int, num_threads: int, **kwargs) -> dict:
+    if num_threads == 0:
+        num_threads = max(os.cpu_count() // num_workers, 1)
+
+    load_mnist_tensors(train=True)
+    load_mnist_tensors(train=False)
+
+    results_queue = torch.multiprocessing.get_context("spawn").SimpleQueue()
+    torch.multiprocessing.spawn(
+        train_worker,
+        args=(num_workers, num_threads, get_free_port(), results_queue, kwargs),
+        nprocs=num_workers,
     )
+    summary = results_queue.get()
+    summary["num_threads"] = num_threads
+    return summary
 
-    optimiser = torch.optim.Adam(model.parameters(), lr=1e-3)
+def benchmark_workers(worker_list: list[int], **kwargs):
+    summary_list = [train_data_parallel(n, **kwargs) for n in worker_list]
 
     table = util.Table(
-        util.TimeColumn("t", width=-11),
-        util.Column("epoch"),
-        util.Column("batch"),
-        util.Column("batch_loss", ".5f", width=10),
-        util.CallbackColumn("train_acc", ".5f", width=10).set_callback(
-            lambda: get_accuracy(model, train_loader),
-            level=1,
-        ),
-        util.CallbackColumn("test_acc", ".5f", width=10).set_callback(
-            lambda: get_accuracy(model, test_loader),
-            level=1,
+        util.Column("workers",  "i"),
+        util.Column("threads",  "i"),
+        util.Column("samples_per_second", ".1f", title="Samples/s"),
+        util.Column("speedup",  ".3f"),
+        util.Column("test_acc", ".5f"),
+    )
+    for num_workers, summary in zip(worker_list, summary_list):
+        table.update(
+            workers=num_workers,
+            threads=summary["num_threads"],
+            samples_per_second=summary["samples_per_second"],
+            speedup=(
+                summary["samples_per_second"]
+                / summary_list[0]["samples_per_second"]
+            ),
+            test_acc=summary["test_acc"],
+        )
+
+    plotting.plot(
+        plotting.Line(
+            worker_list,
+            table.get_data("samples_per_second"),
+            m="o",
+            c="b",
         ),
-        print_interval=util.TimeInterval(1),
+        xlabel="Number of workers",
+        ylabel="Samples/s",
+        plot_name="Data-parallel scaling for mlp_mnist",
+        dir_name=os.path.join(CURRENT_DIR, "img"),
     )
 
-    num_epochs = 3
-    for epoch in range(num_epochs):
-        table.update(level=1, epoch=epoch)
-        for i, (x, t) in enumerate(train_loader):
-            y = model.forward(x)
-            loss = torch.nn.functional.cross_entropy(y, t)
-            optimiser.zero_grad()
-            loss.backward()
-            optimiser.step()
-            table.update(epoch=epoch, batch=i, batch_loss=loss.item())
+def train_precision_worker(kwargs: dict) -> dict:
+    table, _ = train(**kwargs)
+    summary = get_summary(table)
+    summary["peak_memory_mb"] = (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    )
+    return summary
+
+def benchmark_precision(num_threads: int, **kwargs):
+    """
+    Train once with each precision, each in a fresh process so that the peak
+    resident memory of each run can be measured independently.
+    """
+    precision_list = ["float32", "bfloat16"]
+    ctx = torch.multiprocessing.get_context("spawn")
+    summary_list = []
+    for precision in precision_list:
+        kwargs["precision"] = precision
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=ctx,
+            initializer=(torch.set_num_threads if num_threads > 0 else None),
+            initargs=((num_threads,) if num_threads > 0 else ()),
+        ) as executor:
+            summary = executor.submit(train_precision_worker, kwargs).result()
+            summary_list.append(summary)
+
+    table = util.Table(
+        util.Column("precision",    width=-10),
+        util.Column("samples_per_second", ".1f", title="Samples/s"),
+        util.Column("speedup",      ".3f"),
+        util.Column("test_acc",     ".5f"),
+        util.Column("acc_diff",     ".5f", title="Acc - fp32"),
+        util.Column("peak_memory_mb", ".1f", title="Peak MB"),
+    )
+    s32 = summary_list[0]
+    for precision, summary in zip(precision_list, summary_list):
+        table.update(
+            precision=precision,
+            samples_per_second=summary["samples_per_second"],
+            speedup=summary["samples_per_second"]/s32["samples_per_second"],
+            test_acc=summary["test_acc"],
+            acc_diff=summary["test_acc"] - s32["test_acc"],
+            peak_memory_mb=summary["peak_memory_mb"],
+        )
+
+def init_sweep_worker(mnist_tensors: dict, num_threads: int):
+    MNIST_TENSORS.update(mnist_tensors)
+    torch.set_num_threads(num_threads)
+
+def train_sweep_config(kwargs: dict) -> util.Table:
+    table, _ = train(**kwargs, printer=util.Printer(print_to_console=False))
+    return table
 
-        table.print_last()
+def run_sweep(
+    hidden_dim_list:        list[int],
+    num_hidden_layers_list: list[int],
+    lr_list:                list[float],
+    num_processes:          int,
+    num_threads:            int,
+    **kwargs,
+):
+    """
+    Train every combination of `hidden_dim_list`, `num_hidden_layers_list`
+    and `lr_list` in a pool of `num_processes` processes. MNIST is loaded
+    once in this process and shared with every worker through shared memory.
+    """
+    if num_threads == 0:
+        num_threads = max(os.cpu_count() // num_processes, 1)
 
-    table.update(level=1, epoch=num_epochs)
+    if kwargs["checkpoint_path"] is not None:
+        raise ValueError("Checkpointing is not supported in sweeps")
+    if kwargs["data"] != "tensor":
+        raise ValueError("Sweeps require --data tensor")
+
+    mnist_tensors = {
+        is_train: tuple(
+            x.clone().share_memory_()
+            for x in load_mnist_tensors(is_train)
+        )
+        for is_train in [True, False]
+    }
+
+    config_list = [
+        {"hidden_dim": h, "num_hidden_layers": n, "lr": lr}
+        for h, n, lr in itertools.product(
+            hidden_dim_list,
+            num_hidden_layers_list,
+            lr_list,
+        )
+    ]
+    kwargs_list = [{**kwargs, **config} for config in config_list]
+
+    ctx = torch.multiprocessing.get_context("spawn")
+    with ctx.Pool(
+        processes=num_processes,
+        initializer=init_sweep_worker,
+        initargs=(mnist_tensors, num_threads),
+    ) as pool:
+        table_list = pool.map(train_sweep_config, kwargs_list)
+
+    summary_table = util.Table(
+        util.Column("hidden_dim",   "i"),
+        util.Column("num_hidden_layers", "i", title="Layers"),
+        util.Column("lr",           ".1e"),
+        util.Column("train_acc",    ".5f"),
+        util.Column("test_acc",     ".5f"),
+        util.Column("samples_per_second", ".1f", title="Samples/s"),
+    )
+    table_dict = dict()
+    for config, table in zip(config_list, table_list):
+        summary = get_summary(table)
+        summary_table.update(
+            **config,
+            train_acc=table.get_data("train_acc")[-1],
+            test_acc=summary["test_acc"],
+            samples_per_second=summary["samples_per_second"],
+        )
+        name = "h=%i, n=%i, lr=%.1e" % tuple(config.values())
+        table_dict[name] = table
+
+    plot_name = "Metrics for mlp_mnist sweep"
+    plot_metrics(table_dict, plot_name, os.path.join(CURRENT_DIR, "img"))
+
+def main(num_workers: int, num_threads: int, **kwargs):
+    if num_workers > 1:
+        train_data_parallel(num_workers, num_threads, **kwargs)
+        return
+
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+
+    table, model = train(**kwargs)
 
     plot_name = "Metrics for %s" % model
     plot_metrics(table, plot_name, os.path.join(CURRENT_DIR, "img"))
 
 if __name__ == "__main__":
+    parser = cli.Parser(
+        cli.Arg(
+            "data",
+            type=str,
+            default="tensor",
+            choices=["tensor", "torchvision"],
+        ),
+        cli.Arg("batch_size",       type=int, default=100),
+        cli.Arg("num_epochs",       type=int, default=3),
+        cli.Arg("eval_batch_size",  type=int, default=10000),
+        cli.Arg("full_train_acc",   action="store_true"),
+        cli.Arg("compiled",         action="store_true"),
+        cli.Arg(
+            "precision",
+            type=str,
+            default="float32",
+            choices=["float32", "bfloat16"],
+        ),
+        cli.Arg("hidden_dim",       type=int, default=100),
+        cli.Arg("num_hidden_layers", type=int, default=2),
+        cli.Arg("lr",               type=float, default=1e-3),
+        cli.Arg("checkpoint_path",  type=str, default=None),
+        cli.Arg("checkpoint_interval", type=float, default=60),
+        cli.Arg("num_workers",      type=int, default=1),
+        cli.Arg("num_threads",      type=int, default=0),
+        cli.Arg(
+            "benchmark",
+            type=str,
+            default=None,
+            choices=["data", "workers", "compile", "precision"],
+        ),
+        cli.Arg("worker_list",      type=int, default=[1, 2, 4, 8], nargs="+"),
+        cli.Arg("hidden_dim_list",  type=int, default=[10, 100, 1000], nargs="+"),
+        cli.Arg("num_hidden_layers_list", type=int, default=[1, 2, 3], nargs="+"),
+        cli.Arg("num_warmup_steps", type=int, default=20),
+        cli.Arg("num_timed_steps",  type=int, default=200),
+        cli.Arg("sweep",            action="store_true"),
+        cli.Arg("lr_list",          type=float, default=[1e-3], nargs="+"),
+        cli.Arg("num_processes",    type=int, default=4),
+    )
+    args = parser.parse_args()
+    kwargs = args.get_kwargs()
+    benchmark = kwargs.pop("benchmark")
+    sweep = kwargs.pop("sweep")
+    worker_list = kwargs.pop("worker_list")
+    grid_kwargs = {
+        k: kwargs.pop(k)
+        for k in ["hidden_dim_list", "num_hidden_layers_list"]
+    }
+    compile_kwargs = {
+        k: kwargs.pop(k)
+        for k in ["num_warmup_steps", "num_timed_steps"]
+    }
+    sweep_kwargs = {
+        k: kwargs.pop(k)
+        for k in ["lr_list", "num_processes"]
+    }
+
     with util.Timer("main"):
-        main()
+        if sweep:
+            for k in ["num_workers", "hidden_dim", "num_hidden_layers", "lr"]:
+                kwargs.pop(k)
+
+            run_sweep(**grid_kwargs, **sweep_kwargs, **kwargs)
+        elif benchmark is None:
+            main(**kwargs)
+        elif benchmark == "data":
+            benchmark_data(kwargs["batch_size"], kwargs["num_epochs"])
+        elif benchmark == "workers":
+            kwargs.pop("num_workers")
+            benchmark_workers(worker_list, **kwargs)
+        elif benchmark == "compile":
+            benchmark_compile(
+                kwargs["batch_size"],
+                **grid_kwargs,
+                **compile_kwargs,
+            )
+        elif benchmark == "precision":
+            kwargs.pop("num_workers")
+            benchmark_precision(**kwargs)
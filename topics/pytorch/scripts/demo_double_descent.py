@@ -1,3 +1,5 @@
+import os
+import multiprocessing as mp
 import torch
 from jutility import plotting, util, cli
 
@@ -9,47 +11,177 @@ def main(
     output_dim: int,
     std:        float,
     n_list:     list[int],
+    n_test:     int,
 ):
+    """
+    Fit every solver to `repeats` independent datasets for each training set
+    size in `n_list`. The training sets are nested: each repeat draws
+    `max(n_list)` training points once, and the training set for each `n` is
+    the first `n` of them, so results for different `n` are correlated. Every
+    `n` is evaluated on the same test set of `n_test` points per repeat.
+
+    `NormalEquations` updates its state with only the points added since the
+    previous `n`, so its recorded time for each `n` is the cumulative time of
+    every update up to and including that `n`, which is the total cost of
+    reaching that solution and comparable to the other solvers.
+    """
     torch.manual_seed(seed)
 
+    n_list = sorted(n_list)
+    data = Data(repeats, max(n_list), n_test, input_dim, output_dim, std)
     results = Results("svd", "lstsq", "lstsq_gelsd", "solve")
-    timer   = util.Timer(verbose=False)
+    solver_dict = {
+        w_type: get_solver(w_type, repeats, input_dim, output_dim)
+        for w_type in results.w_types
+    }
+    timer = util.Timer(verbose=False)
+    t_incremental = 0.0
 
     for n in n_list:
-        for _ in range(repeats):
-            x = torch.normal(0, 1, [n, input_dim])
-            w = torch.normal(0, 1, [input_dim, output_dim])
-            y = x @ w + torch.normal(0, std, [n, output_dim])
-            x_test = torch.normal(0, 1, [n, input_dim])
-            y_test = x_test @ w + torch.normal(0, std, [n, output_dim])
-            args = [n, x, y, x_test, y_test]
-
-            with timer:
-                cov_xy_io = x.T @ y
-                cov_xx_ii = x.T @ x
-                cov_xx_ii.diagonal().add_(1e-3)
-                w = torch.linalg.solve(cov_xx_ii, cov_xy_io)
-            results.update("solve", w, timer.get_last(), *args)
-
+        x, y = data.get_train(n)
+        for w_type, solver in solver_dict.items():
+            reset_peak_memory()
+            mem_0 = get_memory()
             with timer:
-                u, sd, v = torch.linalg.svd(x)
-                s_inv = torch.zeros(x.T.shape)
-                s_inv.diagonal().copy_(1 / sd)
-                w = v.T @ s_inv @ u.T @ y
-            results.update("svd", w, timer.get_last(), *args)
+                w, y_pred = solver(x, y)
 
-            with timer:
-                w, _, _, _ = torch.linalg.lstsq(x, y)
-            results.update("lstsq", w, timer.get_last(), *args)
+            mem = get_peak_memory() - mem_0
+            t = timer.get_last()
+            if isinstance(solver, NormalEquations):
+                t_incremental += t
+                t = t_incremental
 
-            with timer:
-                w, _, _, _ = torch.linalg.lstsq(x, y, driver="gelsd")
-            results.update("lstsq_gelsd", w, timer.get_last(), *args)
+            results.update(w_type, w, y_pred, t, mem, n, data)
 
         print(results.table.format_header())
 
     results.plot(input_dim, std, name)
 
+class Data:
+    def __init__(
+        self,
+        repeats:    int,
+        n_max:      int,
+        n_test:     int,
+        input_dim:  int,
+        output_dim: int,
+        std:        float,
+    ):
+        """
+        Sample every repeat at once, with shape `[repeats, n, input_dim]`. The
+        training set for each `n` is the first `n` rows of `self.x`, so that
+        `NormalEquations` can update `X^T X` incrementally as `n` grows, and
+        the test set has a fixed size `n_test`.
+        """
+        self.w = torch.normal(0, 1, [repeats, input_dim, output_dim])
+        self.x = torch.normal(0, 1, [repeats, n_max, input_dim])
+        self.y = self.x @ self.w
+        self.y += torch.normal(0, std, self.y.shape)
+        self.x_test = torch.normal(0, 1, [repeats, n_test, input_dim])
+        self.y_test = self.x_test @ self.w
+        self.y_test += torch.normal(0, std, self.y_test.shape)
+
+    def get_train(self, n: int) -> tuple[torch.Tensor, torch.Tensor]:
+        return self.x[:, :n], self.y[:, :n]
+
+def solve_svd(
+    x: torch.Tensor,
+    y: torch.Tensor,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Minimum-norm least squares solution using a reduced SVD, which needs
+    `O(n * d)` memory instead of the `O(n^2)` of a full SVD. The same
+    factorisation gives the training predictions as `u @ (u^T @ y)`.
+    """
+    u, sd, vh = torch.linalg.svd(x, full_matrices=False)
+    uty = u.mT @ y
+    w = vh.mT @ (uty / sd.unsqueeze(-1))
+    return w, u @ uty
+
+def solve_lstsq(
+    x:      torch.Tensor,
+    y:      torch.Tensor,
+    driver: (str | None)=None,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    w, _, _, _ = torch.linalg.lstsq(x, y, driver=driver)
+    return w, x @ w
+
+class NormalEquations:
+    def __init__(self, repeats: int, input_dim: int, output_dim: int):
+        """
+        Ridge-regularised normal equations, where `X^T X` and `X^T y` are
+        updated with only the rows added since the previous call, so growing
+        the training set from `n_1` to `n_2` rows costs `O((n_2 - n_1) *
+        d^2)` instead of `O(n_2 * d^2)`.
+        """
+        self.cov_xx = torch.zeros([repeats, input_dim, input_dim])
+        self.cov_xy = torch.zeros([repeats, input_dim, output_dim])
+        self.n = 0
+
+    def __call__(
+        self,
+        x: torch.Tensor,
+        y: torch.Tensor,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        x_new = x[:, self.n:]
+        y_new = y[:, self.n:]
+        self.cov_xx.baddbmm_(x_new.mT, x_new)
+        self.cov_xy.baddbmm_(x_new.mT, y_new)
+        self.n = x.shape[-2]
+
+        cov_xx_ii = self.cov_xx.clone()
+        cov_xx_ii.diagonal(dim1=-2, dim2=-1).add_(1e-3)
+        w = torch.linalg.solve(cov_xx_ii, self.cov_xy)
+        return w, x @ w
+
+def solve_lstsq_gelsd(
+    x: torch.Tensor,
+    y: torch.Tensor,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    return solve_lstsq(x, y, driver="gelsd")
+
+def get_solver(
+    w_type:     str,
+    repeats:    int,
+    input_dim:  int,
+    output_dim: int,
+):
+    if w_type == "svd":
+        return solve_svd
+    if w_type == "lstsq":
+        return solve_lstsq
+    if w_type == "lstsq_gelsd":
+        return solve_lstsq_gelsd
+    if w_type == "solve":
+        return NormalEquations(repeats, input_dim, output_dim)
+
+    raise ValueError("Unknown w_type %r" % w_type)
+
+def get_memory(key: str="VmRSS") -> float:
+    """
+    Return the resident set size (or its peak, if `key == "VmHWM"`) of the
+    current process in MB, or `nan` if `/proc` is unavailable.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(key + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return float("nan")
+
+def get_peak_memory() -> float:
+    return get_memory("VmHWM")
+
+def reset_peak_memory():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
 class Results:
     def __init__(self, *w_types: str):
         self.w_types = w_types
@@ -78,6 +210,7 @@ class Results:
             util.Column("rmse", ".5f"),
             util.Column("test", ".5f"),
             util.Column("time", ".5f"),
+            util.Column("mem",  ".1f", title="Peak MB"),
             util.Column("norm", ".5f"),
         )
 
@@ -85,28 +218,37 @@ class Results:
         self,
         w_type: str,
         w:      torch.Tensor,
+        y_pred: torch.Tensor,
         t:      float,
+        mem:    float,
         n:      int,
-        x:      torch.Tensor,
-        y:      torch.Tensor,
-        x_test: torch.Tensor,
-        y_test: torch.Tensor,
+        data:   "Data",
     ):
-        norm = w.square().mean().item()
-        rmse = ((x @ w) - y).square().mean().sqrt().item()
-        test = ((x_test @ w) - y_test).square().mean().sqrt().item()
-        self.rmse_results[w_type].update(n, rmse)
-        self.test_results[w_type].update(n, test)
-        self.time_results[w_type].update(n, t)
-        self.norm_results[w_type].update(n, norm)
-        self.table.update(
-            n=n,
-            w_type=w_type,
-            rmse=rmse,
-            test=test,
-            time=t,
-            norm=norm,
-        ),
+        """
+        `w` and `y_pred` contain every repeat, and `t` and `mem` are the time
+        and peak memory for solving every repeat at once. The recorded time
+        is per repeat.
+        """
+        x, y = data.get_train(n)
+        norm = w.square().mean(dim=[-2, -1])
+        rmse = (y_pred - y).square().mean(dim=[-2, -1]).sqrt()
+        y_test_pred = data.x_test @ w
+        test = (y_test_pred - data.y_test).square().mean(dim=[-2, -1]).sqrt()
+        t = t / w.shape[0]
+        for i in range(w.shape[0]):
+            self.rmse_results[w_type].update(n, rmse[i].item())
+            self.test_results[w_type].update(n, test[i].item())
+            self.time_results[w_type].update(n, t)
+            self.norm_results[w_type].update(n, norm[i].item())
+            self.table.update(
+                n=n,
+                w_type=w_type,
+                rmse=rmse[i].item(),
+                test=test[i].item(),
+                time=t,
+                mem=mem,
+                norm=norm[i].item(),
+            )
 
     def plot(
         self,
@@ -174,6 +316,156 @@ class Results:
         )
         mp.save(name, "topics/pytorch/img")
 
+def microbenchmark(
+    seed:               int,
+    repeats:            int,
+    input_dim:          int,
+    output_dim:         int,
+    std:                float,
+    n_list:             list[int],
+    num_threads_list:   list[int],
+    warmup:             int,
+    timed_reps:         int,
+    processes:          bool,
+    w_types:            list[str],
+    name:               str,
+):
+    """
+    For each thread count and training set size, time each solver with
+    `warmup` untimed calls followed by `timed_reps` timed calls, each solving
+    from scratch, and report the median and inter-quartile range of the time
+    per repeat. By default every repeat is solved as one batch in this
+    process; if `processes` is `True`, each repeat is solved in a separate
+    process (each using the given number of threads), and the timings from
+    all processes are pooled. These processes run one at a time, so that at
+    most `num_threads` threads are ever running and the repeats don't compete
+    for CPUs. Thread counts above `os.cpu_count()` are skipped, because
+    batched solves in MKL can deadlock when oversubscribed.
+    """
+    num_cpus = os.cpu_count()
+    skipped = [n for n in num_threads_list if n > num_cpus]
+    if len(skipped) > 0:
+        print(
+            "Warning: skipping num_threads %s > os.cpu_count() = %i"
+            % (skipped, num_cpus)
+        )
+        num_threads_list = [n for n in num_threads_list if n <= num_cpus]
+
+    table = util.Table(
+        util.Column("num_threads",  "i", width=11),
+        util.Column("n",            "i", width=6),
+        util.Column("w_type",       width=15),
+        util.Column("median",       ".3e"),
+        util.Column("iqr",          ".3e", title="IQR"),
+    )
+    median = {(t, wt): [] for t in num_threads_list for wt in w_types}
+    q1 = {k: [] for k in median}
+    q3 = {k: [] for k in median}
+    q_eval = torch.tensor([0.25, 0.5, 0.75], dtype=torch.float64)
+    for num_threads in num_threads_list:
+        for n in n_list:
+            for w_type in w_types:
+                job_args = [
+                    (
+                        seed + i, (1 if processes else repeats), n,
+                        input_dim, output_dim, std, w_type, num_threads,
+                        warmup, timed_reps,
+                    )
+                    for i in range(repeats if processes else 1)
+                ]
+                if processes:
+                    with mp.Pool(1, maxtasksperchild=1) as pool:
+                        time_lists = pool.starmap(time_solver, job_args)
+                else:
+                    time_lists = [time_solver(*a) for a in job_args]
+
+                t = torch.tensor(sum(time_lists, start=[]), dtype=q_eval.dtype)
+                if not processes:
+                    t /= repeats
+
+                q = torch.quantile(t, q_eval)
+                k = (num_threads, w_type)
+                q1[k].append(q[0].item())
+                median[k].append(q[1].item())
+                q3[k].append(q[2].item())
+                table.update(
+                    num_threads=num_threads,
+                    n=n,
+                    w_type=w_type,
+                    median=q[1].item(),
+                    iqr=(q[2] - q[0]).item(),
+                )
+
+    cp = plotting.ColourPicker(len(num_threads_list))
+    colours = [cp.next() for _ in num_threads_list]
+    mp_plot = plotting.MultiPlot(
+        *[
+            plotting.Subplot(
+                *[
+                    line
+                    for num_threads, c in zip(num_threads_list, colours)
+                    for line in [
+                        plotting.Line(
+                            n_list,
+                            median[num_threads, w_type],
+                            c=c,
+                            m="o",
+                        ),
+                        plotting.FillBetween(
+                            n_list,
+                            q1[num_threads, w_type],
+                            q3[num_threads, w_type],
+                            c=c,
+                            alpha=0.3,
+                        ),
+                    ]
+                ],
+                log_x=True,
+                log_y=True,
+                xlabel="Train sample size",
+                ylabel="Time per repeat (s)",
+                title=w_type,
+            )
+            for w_type in w_types
+        ],
+        legend=plotting.FigureLegend(
+            *[
+                plotting.Line(c=c, label="%i" % num_threads)
+                for num_threads, c in zip(num_threads_list, colours)
+            ],
+            title="Threads",
+        ),
+    )
+    mp_plot.save(name, "topics/pytorch/img")
+
+def time_solver(
+    seed:       int,
+    repeats:    int,
+    n:          int,
+    input_dim:  int,
+    output_dim: int,
+    std:        float,
+    w_type:     str,
+    num_threads: int,
+    warmup:     int,
+    timed_reps: int,
+) -> list[float]:
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(seed)
+    data = Data(repeats, n, 1, input_dim, output_dim, std)
+    x, y = data.get_train(n)
+    timer = util.Timer(verbose=False)
+    time_list = []
+    for i in range(warmup + timed_reps):
+        solver = get_solver(w_type, repeats, input_dim, output_dim)
+        with timer:
+            solver(x, y)
+
+        if i >= warmup:
+            time_list.append(timer.get_last())
+
+    return time_list
+
 if __name__ == "__main__":
     parser = cli.Parser(
         cli.Arg("seed",         type=int,   default=0),
@@ -187,9 +479,45 @@ if __name__ == "__main__":
             nargs="+",
             default=[10, 30, 100, 300, 1000, 3000, 10000],
         ),
+        cli.Arg("n_test",       type=int,   default=1000),
+        cli.Arg("microbenchmark",   action="store_true", tagged=False),
+        cli.Arg(
+            "num_threads_list",
+            type=int,
+            nargs="+",
+            default=[1, 2, 4],
+            tagged=False,
+        ),
+        cli.Arg("warmup",           type=int, default=2,    tagged=False),
+        cli.Arg("timed_reps",       type=int, default=10,   tagged=False),
+        cli.Arg("processes",        action="store_true",    tagged=False),
     )
     args = parser.parse_args()
-    name = "demo_double_descent_%s" % args.get_summary()
+    kwargs = args.get_kwargs()
+    benchmark_kwargs = {
+        k: kwargs.pop(k)
+        for k in [
+            "microbenchmark",
+            "num_threads_list",
+            "warmup",
+            "timed_reps",
+            "processes",
+        ]
+    }
 
     with util.Timer("main"):
-        main(name=name, **args.get_kwargs())
+        if benchmark_kwargs.pop("microbenchmark"):
+            name = "demo_double_descent_microbenchmark_%s" % args.get_summary()
+            if benchmark_kwargs["processes"]:
+                name += "_processes"
+
+            kwargs.pop("n_test")
+            microbenchmark(
+                **kwargs,
+                **benchmark_kwargs,
+                w_types=["svd", "lstsq", "lstsq_gelsd", "solve"],
+                name=name,
+            )
+        else:
+            name = "demo_double_descent_%s" % args.get_summary()
+            main(name=name, **kwargs)